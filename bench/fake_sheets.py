@@ -0,0 +1,202 @@
+import json
+import time
+import threading
+from collections import Counter
+from datetime import date, timedelta
+
+from gspread.utils import a1_to_rowcol, a1_range_to_grid_range
+
+
+# Подставной Google Sheets в памяти: повторяет ту часть API gspread, которой пользуется bot.py,
+# считает вызовы и объём переданных данных и умеет имитировать сетевую задержку
+
+
+def payload_size(data):
+    # Примерный объём данных в запросе/ответе — как если бы они шли через API в JSON
+    return len(json.dumps(data, ensure_ascii=False, default=str).encode())
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = Counter()  # метод -> число вызовов
+        self.bytes = 0
+
+    def record(self, method, data):
+        with self.lock:
+            self.calls[method] += 1
+            self.bytes += payload_size(data)
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.calls), self.bytes
+
+
+class FakeCell:
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = value
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, values):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.values = [list(row) for row in values]
+        self.lock = threading.Lock()
+
+    def call(self, method, data):
+        # Задержка «сети» и учёт вызова
+        if self.spreadsheet.latency:
+            time.sleep(self.spreadsheet.latency)
+        self.spreadsheet.stats.record(method, data)
+        return data
+
+    def get_all_values(self, **kwargs):
+        with self.lock:
+            width = max((len(row) for row in self.values), default=0)
+            values = [row + [""] * (width - len(row)) for row in self.values]
+        return self.call("get_all_values", values)
+
+    def get(self, range_name=None, **kwargs):
+        return self.call("get", self.read_range(range_name))
+
+    def read_range(self, range_name):
+        grid = a1_range_to_grid_range(range_name)
+        with self.lock:
+            rows = self.values[grid.get("startRowIndex", 0):grid.get("endRowIndex", len(self.values))]
+            values = [row[grid.get("startColumnIndex", 0):grid.get("endColumnIndex")] for row in rows]
+        # Как и API, отрезаем пустые ячейки в конце строк и пустые строки в конце диапазона
+        values = [row[:max((i + 1 for i, cell in enumerate(row) if cell != ""), default=0)] for row in values]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def batch_get(self, ranges, **kwargs):
+        return [self.get(range_name) for range_name in ranges]
+
+    def row_values(self, row, **kwargs):
+        with self.lock:
+            values = list(self.values[row - 1]) if row <= len(self.values) else []
+        return self.call("row_values", values)
+
+    def acell(self, label, **kwargs):
+        row, col = a1_to_rowcol(label)
+        with self.lock:
+            value = self.values[row - 1][col - 1] if row <= len(self.values) and col <= len(self.values[row - 1]) else ""
+        self.call("acell", value)
+        return FakeCell(row, col, value)
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+    def append_rows(self, values, **kwargs):
+        rows = [[cell if isinstance(cell, str) else format_number(cell) for cell in row] for row in values]
+        with self.lock:
+            self.values.extend(rows)
+        self.call("append_rows", values)
+        return {"updates": {"updatedRows": len(rows)}}
+
+    def insert_row(self, values, index=1, **kwargs):
+        with self.lock:
+            self.values.insert(index - 1, list(values))
+        self.call("insert_row", values)
+
+    def update(self, values=None, range_name=None, **kwargs):
+        # Поддерживаем оба порядка аргументов, как gspread 6: update("A1", [[...]]) и update([[...]], "A1")
+        if isinstance(values, str):
+            values, range_name = range_name, values
+        row, col = a1_to_rowcol((range_name or "A1").split(":")[0])
+        with self.lock:
+            for i, new_row in enumerate(values):
+                while len(self.values) < row + i:
+                    self.values.append([])
+                target = self.values[row + i - 1]
+                target.extend([""] * (col - 1 + len(new_row) - len(target)))
+                target[col - 1:col - 1 + len(new_row)] = [str(cell) for cell in new_row]
+        self.call("update", values)
+        return {"updatedRows": len(values)}
+
+
+def format_number(value):
+    # Так число отображается в таблице после записи: 1500.0 -> "1500"
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+
+class FakeSpreadsheet:
+    def __init__(self, client, key, values):
+        self.client = client
+        self.id = key
+        self.latency = client.latency
+        self.stats = client.stats
+        self._worksheets = [FakeWorksheet(self, "Sheet1", values)]
+
+    @property
+    def sheet1(self):
+        return self.get_worksheet(0)
+
+    def get_worksheet(self, index):
+        self.stats.record("get_worksheet", index)
+        return self._worksheets[index]
+
+    def worksheet(self, title):
+        self.stats.record("worksheet", title)
+        for worksheet in self._worksheets:
+            if worksheet.title == title:
+                return worksheet
+        raise KeyError(title)
+
+    def worksheets(self, **kwargs):
+        self.stats.record("worksheets", [ws.title for ws in self._worksheets])
+        return list(self._worksheets)
+
+    def add_worksheet(self, title, rows=100, cols=20, **kwargs):
+        worksheet = FakeWorksheet(self, title, [])
+        self._worksheets.append(worksheet)
+        self.stats.record("add_worksheet", title)
+        return worksheet
+
+
+class FakeSession:
+    def mount(self, prefix, adapter):
+        pass
+
+
+class FakeHTTPClient:
+    def __init__(self):
+        self.session = FakeSession()
+
+
+class FakeClient:
+    # Замена gspread.Client: open_by_key отдаёт таблицы, созданные make_spreadsheet_values
+    def __init__(self, rows=100, latency=0.0):
+        self.rows = rows
+        self.latency = latency
+        self.stats = Stats()
+        self.http_client = FakeHTTPClient()
+        self.spreadsheets = {}
+
+    def set_timeout(self, timeout):
+        pass
+
+    def open_by_key(self, key):
+        if key not in self.spreadsheets:
+            self.spreadsheets[key] = FakeSpreadsheet(self, key, make_spreadsheet_values(self.rows))
+        self.stats.record("open_by_key", key)
+        return self.spreadsheets[key]
+
+
+def make_spreadsheet_values(rows, today=None, days=365, categories=("еда", "транспорт", "кафе", "дом", "здоровье")):
+    # Лист в том же формате, что и настоящий: шапка с лимитами в строках 1–20, траты с 21-й строки
+    today = today or date.today()
+    values = [["Статья расходов", "Стоимость, AMD", ""]] + [["", "", ""] for _ in range(19)]
+    # Sheets отдаёт числа с неразрывным пробелом между разрядами
+    values[14] = ["Daily budget limit, AMD", "10\xa0000", ""]
+    values[16] = ["Balance, AMD", "300\xa0000", ""]
+    values[17] = ["First day budget, AMD", "10\xa0000", ""]
+    values[19] = ["Daily expenses", "", ""]
+    for i in range(rows):
+        day = today - timedelta(days=i * days // max(rows, 1))
+        values.append([categories[i % len(categories)], str(500 + (i * 37) % 4500), day.strftime("%Y-%m-%d")])
+    return values
@@ -0,0 +1,156 @@
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+from datetime import datetime
+from itertools import count
+from collections import Counter, defaultdict
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendMessage, SendPhoto
+from aiogram.types import Chat, Message, Update, User
+
+from bench.run import setup, teardown, percentile
+
+# Нагрузочный тест: синтетические апдейты от многих чатов идут через dp, ответы в Telegram не уходят.
+# Запуск из корня репозитория: python -m bench.load --chats 200 --messages 20 --mix expense=90,stats=5,chart=5
+
+TEXTS = {
+    "expense": lambda: f"{random.choice(['еда', 'транспорт', 'кафе', 'дом'])}, {random.randint(100, 5000)}",
+    "stats": lambda: "/stats",
+    "chart": lambda: "/chart",
+    "budget_left": lambda: "/budget_left",
+}
+
+
+class FakeSession(BaseSession):
+    # Сессия Bot, которая запоминает исходящие вызовы вместо запросов к Telegram
+    def __init__(self):
+        super().__init__()
+        self.calls = Counter()
+        self.message_id = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if isinstance(method, (SendMessage, SendPhoto)):
+            self.message_id += 1
+            return Message(
+                message_id=self.message_id,
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id, type="private"),
+                text=getattr(method, "text", None),
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def make_update(update_id, chat_id, text):
+    user = User(id=chat_id, is_bot=False, first_name=f"user{chat_id}")
+    return Update(
+        update_id=update_id,
+        message=Message(
+            message_id=update_id,
+            date=datetime.now(),
+            chat=Chat(id=chat_id, type="private"),
+            from_user=user,
+            text=text,
+        ),
+    )
+
+
+def parse_mix(raw):
+    mix = {}
+    for part in raw.split(","):
+        name, weight = part.split("=")
+        if name not in TEXTS:
+            raise SystemExit(f"Неизвестный тип сообщения: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота через Dispatcher")
+    parser.add_argument("--chats", type=int, default=100, help="Сколько чатов пишут одновременно")
+    parser.add_argument("--messages", type=int, default=20, help="Сообщений от каждого чата")
+    parser.add_argument("--mix", default="expense=90,stats=5,chart=5", help="Доли типов сообщений")
+    parser.add_argument("--think", type=float, default=0.0, help="Пауза между сообщениями одного чата, в секундах")
+    parser.add_argument("--rows", type=int, default=1000, help="Строк с тратами в подставной таблице")
+    parser.add_argument("--latency", type=float, default=0.0, help="Задержка одного запроса к Sheets, в секундах")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+async def measure_loop_lag(samples, interval=0.01):
+    # Насколько позже положенного просыпается цикл событий
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def run_chat(bot, chat_id, args, kinds, weights, latencies, update_ids):
+    for _ in range(args.messages):
+        kind = random.choices(kinds, weights)[0]
+        update = make_update(next(update_ids), chat_id, TEXTS[kind]())
+        started = time.perf_counter()
+        await bot.dp.feed_update(bot.bot, update)
+        latencies[kind].append(time.perf_counter() - started)
+        if args.think:
+            await asyncio.sleep(random.uniform(0, args.think * 2))
+
+
+async def main():
+    args = parse_args()
+    random.seed(args.seed)
+    mix = parse_mix(args.mix)
+    kinds, weights = list(mix), list(mix.values())
+
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+    session = FakeSession()
+    bot.bot = bot.Bot(token=bot.BOT_TOKEN, session=session)
+    bot.register_handlers()
+    await asyncio.to_thread(bot.start_chart_pool)  # Как в main(): запуск пула графиков не входит в замеры
+
+    latencies = defaultdict(list)
+    lag = []
+    with tempfile.TemporaryDirectory() as workdir:
+        fake_client, _ = await setup(bot, args.rows, args.latency, workdir)
+        calls_before, bytes_before = fake_client.stats.snapshot()
+        lag_task = asyncio.create_task(measure_loop_lag(lag))
+        update_ids = count(1)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            run_chat(bot, chat_id, args, kinds, weights, latencies, update_ids)
+            for chat_id in range(1, args.chats + 1)
+        ))
+        elapsed = time.perf_counter() - started
+        lag_task.cancel()
+        await teardown(bot)
+        calls_after, bytes_after = fake_client.stats.snapshot()
+
+    bot.chart_executor.shutdown()
+    total = sum(len(values) for values in latencies.values())
+    print(f"Апдейтов: {total} за {elapsed:.2f} с — {total / elapsed:.1f} в секунду")
+    print(f"Запросов к Sheets: {sum(calls_after.values()) - sum(calls_before.values())}, "
+          f"{(bytes_after - bytes_before) / 1024:.1f} КБ")
+    print(f"Вызовов Telegram: {dict(session.calls)}")
+    print(f"{'тип':<12} {'кол-во':>7} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    for kind, values in sorted(latencies.items()) + [("все", [v for vs in latencies.values() for v in vs])]:
+        print(f"{kind:<12} {len(values):>7} {percentile(values, 0.5) * 1000:>9.2f} "
+              f"{percentile(values, 0.95) * 1000:>9.2f} {percentile(values, 0.99) * 1000:>9.2f}")
+    if lag:
+        print(f"Задержка цикла событий: p50 {percentile(lag, 0.5) * 1000:.2f} мс, "
+              f"p99 {percentile(lag, 0.99) * 1000:.2f} мс, макс {max(lag) * 1000:.2f} мс")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,146 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+from types import SimpleNamespace
+
+# Бенчмарк команд бота на подставной таблице: время, число запросов к Sheets и объём данных на команду.
+# Запуск из корня репозитория: python -m bench.run --sizes 100,1000,10000,100000
+
+# bot.py читает настройки при импорте — задаём их до него
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR")
+os.environ.setdefault("SPREADSHEET_NAME", "bench")
+os.environ.setdefault("CREDENTIALS_FILE", "{}")
+os.environ.setdefault("SHEETS_READS_PER_MINUTE", "1000000")
+os.environ.setdefault("SHEETS_WRITES_PER_MINUTE", "1000000")
+os.environ.setdefault("LEDGER_RESYNC_MINUTES", "0")
+os.environ.setdefault("SNAPSHOT_DIR", "")  # Каждый размер таблицы грузится с нуля
+
+from bench.fake_sheets import FakeClient
+
+COMMANDS = ["add_expense", "budget_left", "stats", "chart", "chart_cached"]
+
+
+class BenchMessage:
+    # Минимальная замена aiogram Message: хватает обработчикам бота
+    def __init__(self, text, chat_id=1):
+        self.text = text
+        self.chat = SimpleNamespace(id=chat_id)
+        self.from_user = SimpleNamespace(id=chat_id)
+        self.replies = []
+
+    async def answer(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк команд бота на подставной Google Таблице")
+    parser.add_argument("--sizes", default="100,1000,10000,100000", help="Размеры таблицы (строк с тратами) через запятую")
+    parser.add_argument("--iterations", type=int, default=20, help="Сколько раз выполнять каждую команду")
+    parser.add_argument("--latency", type=float, default=0.0, help="Задержка одного запроса к Sheets, в секундах")
+    parser.add_argument("--commands", default=",".join(COMMANDS), help="Какие команды мерить")
+    parser.add_argument("--storage", choices=["sheets", "sqlite"], default="sheets", help="Режим хранения (STORAGE_MODE)")
+    parser.add_argument("--batch-window", type=float, default=0.0, help="WRITE_BATCH_WINDOW для записи трат, в секундах")
+    return parser.parse_args()
+
+
+async def setup(bot, size, latency, workdir):
+    # Свежая таблица и чистое состояние бота для каждого размера
+    fake_client = FakeClient(rows=size, latency=latency)
+    bot.open_sheets = lambda: fake_client
+    bot.client = None
+    bot.sheets_connected.clear()
+    bot.SQLITE_PATH = os.path.join(workdir, f"bench-{size}.db")
+    bot.ledgers.clear()
+    bot.ledgers[bot.DEFAULT_SHEET] = bot.make_ledger(bot.DEFAULT_SHEET)
+    bot.contexts = bot.ContextRegistry(bot.CONTEXT_SHARDS)
+    bot.chart_cache.clear()
+
+    started = time.perf_counter()
+    await bot.connect_sheets()
+    return fake_client, time.perf_counter() - started
+
+
+async def teardown(bot):
+    for ledger in list(bot.ledgers.values()):
+        await ledger.stop_writer()
+
+
+async def settle(bot):
+    # В режиме sqlite траты уходят в таблицу фоновой репликацией — ждём, пока она догонит
+    for ledger in bot.ledgers.values():
+        if isinstance(ledger, bot.SqliteLedger):
+            while await ledger.run_db(ledger.pending_count):
+                await asyncio.sleep(0.01)
+
+
+async def run_command(bot, command):
+    if command == "add_expense":
+        await bot.add_expense(BenchMessage("еда, 1500"))
+    elif command == "budget_left":
+        await bot.get_budget_left(BenchMessage("/budget_left"))
+    elif command == "stats":
+        await bot.get_monthly_stats(BenchMessage("/stats"))
+    elif command == "chart":
+        bot.chart_cache.clear()  # Каждый раз рисуем заново
+        await bot.send_expense_chart(BenchMessage("/chart"))
+    elif command == "chart_cached":
+        await bot.send_expense_chart(BenchMessage("/chart"))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def main():
+    args = parse_args()
+    os.environ["STORAGE_MODE"] = args.storage
+    os.environ["WRITE_BATCH_WINDOW"] = str(args.batch_window)
+
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+
+    async def send_photo(**kwargs):
+        return None
+    bot.bot.send_photo = send_photo
+    await asyncio.to_thread(bot.start_chart_pool)  # Как в main(): запуск пула графиков не входит в замеры
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    commands = [command for command in args.commands.split(",") if command]
+    results = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            fake_client, startup = await setup(bot, size, args.latency, workdir)
+            calls, transferred = fake_client.stats.snapshot()
+            results.append((size, "startup", [startup], sum(calls.values()), transferred))
+
+            for command in commands:
+                timings = []
+                calls_before, bytes_before = fake_client.stats.snapshot()
+                for _ in range(args.iterations):
+                    started = time.perf_counter()
+                    await run_command(bot, command)
+                    timings.append(time.perf_counter() - started)
+                # Дожидаемся записи в таблицу, чтобы её запросы попали в счётчики этой команды
+                await settle(bot)
+                calls_after, bytes_after = fake_client.stats.snapshot()
+                results.append((
+                    size, command, timings,
+                    (sum(calls_after.values()) - sum(calls_before.values())) / args.iterations,
+                    (bytes_after - bytes_before) / args.iterations,
+                ))
+            await teardown(bot)
+
+    bot.chart_executor.shutdown()
+    print(f"{'строк':>8}  {'команда':<14} {'среднее, мс':>12} {'p95, мс':>10} {'Sheets/оп':>10} {'КБ/оп':>10}")
+    for size, command, timings, calls, transferred in results:
+        mean = sum(timings) / len(timings) * 1000
+        print(f"{size:>8}  {command:<14} {mean:>12.2f} {percentile(timings, 0.95) * 1000:>10.2f} {calls:>10.2f} {transferred / 1024:>10.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,5 +1,7 @@
+import time
+_import_started = time.perf_counter()  # Отсчёт времени старта — для разбивки по фазам в логах
+
 import logging
-import matplotlib.pyplot as plt
 import pytz
 import gspread
 import asyncio
@@ -7,20 +9,40 @@ import json
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import Message
 from aiogram.filters import Command
-from aiogram import Router
+from aiogram import Router, F
 from oauth2client.service_account import ServiceAccountCredentials
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date as date_type
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 import os
-from aiogram.types import FSInputFile  
-from io import BytesIO, BufferedReader 
-
-
-# Глобальная переменная для хранения начального лимита на месяц
-initial_budget = None
+import functools
+import random
+import itertools
+import contextlib
+import calendar
+import hmac
+import csv
+import io
+import zlib
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+import sqlite3
+import re
+import multiprocessing
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from aiogram.types import BufferedInputFile, InputFile, FSInputFile
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramNetworkError
+import metrics
+import profiling
+import charts
 
-fake_date = None  # Переменная для фейковой даты (для тестов)
 
 # Токен бота
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -28,10 +50,72 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 # Настройки Google Sheets
 SPREADSHEET_NAME = os.getenv("SPREADSHEET_NAME")
 CREDENTIALS_FILE = os.getenv("CREDENTIALS_FILE")
+SHEETS_MAX_WORKERS = int(os.getenv("SHEETS_MAX_WORKERS", "4"))  # Сколько запросов к Sheets выполняется одновременно
+SHEETS_TIMEOUT = float(os.getenv("SHEETS_TIMEOUT", "30"))  # Таймаут одного запроса к Sheets, в секундах
+SHEETS_CONNECT_MAX_DELAY = float(os.getenv("SHEETS_CONNECT_MAX_DELAY", "60"))  # Максимальная пауза между попытками подключения
+# Квоты Google Sheets (запросов в минуту) и повторы при 429/5xx
+SHEETS_READS_PER_MINUTE = int(os.getenv("SHEETS_READS_PER_MINUTE", "60"))
+SHEETS_WRITES_PER_MINUTE = int(os.getenv("SHEETS_WRITES_PER_MINUTE", "60"))
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", "5"))
+SHEETS_BACKOFF_BASE = float(os.getenv("SHEETS_BACKOFF_BASE", "1"))  # Первая пауза перед повтором, в секундах
+SHEETS_BACKOFF_MAX = float(os.getenv("SHEETS_BACKOFF_MAX", "64"))  # Максимальная пауза перед повтором, в секундах
+SHEETS_READ_FRESHNESS = float(os.getenv("SHEETS_READ_FRESHNESS", "2"))  # Сколько секунд результат чтения годится для повторных запросов
+
+# Какие чаты ведут какую таблицу: {"<chat_id>": "<ключ таблицы>"} или {"<chat_id>": {"spreadsheet": "...", "worksheet": "..."}}.
+# Чаты без записи пользуются основной таблицей SPREADSHEET_NAME.
+CHAT_SHEETS = json.loads(os.getenv("CHAT_SHEETS", "{}"))
+CONTEXT_SHARDS = int(os.getenv("CONTEXT_SHARDS", "64"))  # На сколько частей делится реестр чатов
+CONTEXT_IDLE_MINUTES = int(os.getenv("CONTEXT_IDLE_MINUTES", "60"))  # Через сколько минут простоя контекст чата выгружается
+
+# Настройки отрисовки графиков
+CHART_POOL_SIZE = int(os.getenv("CHART_POOL_SIZE", "2"))  # Сколько процессов рисуют графики
+CHART_TIMEOUT = float(os.getenv("CHART_TIMEOUT", "30"))  # Сколько ждать один график, в секундах
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", "16"))  # Сколько готовых графиков держать в памяти
+CHART_CACHE_PER_CHAT = os.getenv("CHART_CACHE_PER_CHAT", "0") == "1"  # Отдельная запись кэша для каждого чата
+CHART_PRERENDER = os.getenv("CHART_PRERENDER", "0") == "1"  # Перерисовывать график в фоне после каждой траты
+CHART_PRERENDER_DELAY = float(os.getenv("CHART_PRERENDER_DELAY", "2"))  # Траты чата за столько секунд — одна перерисовка
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
+# Режим вебхука: если задан WEBHOOK_URL (публичный адрес за reverse proxy), обновления принимает FastAPI вместо опроса.
+# Бот должен работать ровно в одном процессе и в одном экземпляре (в Procfile — один worker): зеркала листов,
+# очереди записи, кэш графиков и состояние чатов живут в его памяти, и второй процесс за тем же прокси разошёлся бы
+# с первым. Вебхук убирает задержку опроса, но не даёт масштабироваться на несколько процессов
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Telegram присылает его в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))  # Сколько обновлений может ждать обработки
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))  # Сколько обновлений обрабатывается одновременно (задачи asyncio, не процессы)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # Сколько соединений Telegram открывает к вебхуку
+
+# Метрики Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 — сервер не запускается)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))  # Как часто замерять задержку цикла событий, в секундах
+
+# Профилирование по запросу: /profile [N] от администратора или PROFILE_REQUESTS=N — первые N сообщений после старта.
+# Итоги — сводка в чат и свёрнутые стеки для flamegraph в PROFILE_DIR. Без ADMIN_CHAT_IDS и REPORT_CHAT_ID /profile выключена
+ADMIN_CHAT_IDS = {int(chat_id) for chat_id in os.getenv("ADMIN_CHAT_IDS", os.getenv("REPORT_CHAT_ID", "")).split(",") if chat_id.strip()}
+PROFILE_REQUESTS = int(os.getenv("PROFILE_REQUESTS", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # Период сэмплирования стека, в секундах
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+handler_seconds = metrics.Histogram("cashtrack_handler_seconds", "Время обработки сообщения по обработчикам", ("handler",))
+sheets_calls = metrics.Counter("cashtrack_sheets_calls", "Запросы к Google Sheets по методам и исходу", ("method", "outcome"))
+sheets_reads_shared = metrics.Counter("cashtrack_sheets_reads_shared", "Чтения, получившие результат уже идущего или свежего запроса", ("method",))
+sheets_call_seconds = metrics.Histogram("cashtrack_sheets_call_seconds", "Время одной попытки запроса к Google Sheets", ("method",))
+budget_cache_lookups = metrics.Counter("cashtrack_budget_cache_lookups", "Обращения к кэшу дневного лимита", ("result",))
+chart_cache_lookups = metrics.Counter("cashtrack_chart_cache_lookups", "Обращения к кэшу графиков", ("result",))
+chart_render_seconds = metrics.Histogram("cashtrack_chart_render_seconds", "Время отрисовки графика в пуле процессов")
+scheduler_job_runs = metrics.Counter("cashtrack_scheduler_job_runs", "Запуски задач планировщика", ("job", "outcome"))
+loop_lag_seconds = metrics.Histogram(
+    "cashtrack_event_loop_lag_seconds", "Насколько позже положенного просыпается цикл событий",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+
 # Инициализация бота и диспетчера
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
@@ -39,86 +123,1572 @@ router = Router()
 
 dp.include_router(router)  # Добавляем роутер в диспетчер
 
-# Подключение к Google Sheets
+# Подключение к Google Sheets — не при импорте, а в фоне после старта бота (см. connect_sheets)
 scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive.file"]
-credentials_json = json.loads(os.getenv("CREDENTIALS_FILE"))
-creds = ServiceAccountCredentials.from_json_keyfile_dict(credentials_json, scope)
-client = gspread.authorize(creds)
-sheet = client.open_by_key(SPREADSHEET_NAME).sheet1  # Открываем по ID
+client = None
+sheets_connected = asyncio.Event()  # Выставляется, когда клиент Google Sheets авторизован
+
+# Длительность фаз старта в секундах — выводится в лог, когда бот полностью готов
+startup_timings = {}
+
+# Пул потоков для синхронных вызовов gspread, чтобы не блокировать цикл событий aiogram
+sheets_executor = ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS, thread_name_prefix="sheets")
+
+# Процессы пула графиков запускаются не fork-ом: в копии процесса с потоками gspread/requests могут остаться
+# захваченные чужие блокировки, и дочерний процесс зависнет. forkserver один раз импортирует бота в чистом процессе
+# без потоков и дальше копирует уже его
+chart_mp_context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+
+def make_chart_pool():
+    return ProcessPoolExecutor(max_workers=CHART_POOL_SIZE, mp_context=chart_mp_context, initializer=charts.warm_up)
+
+
+# Пул процессов для matplotlib: отрисовка графика не тормозит запись трат
+chart_executor = make_chart_pool()
+
+
+def open_sheets():
+    # Авторизация в Google Sheets (синхронно — вызывается через sheets_call)
+    credentials_json = json.loads(os.getenv("CREDENTIALS_FILE"))
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(credentials_json, scope)
+    new_client = gspread.authorize(creds)
+    new_client.set_timeout(SHEETS_TIMEOUT)
+    # Одна авторизованная сессия на все потоки: пул соединений по числу воркеров
+    new_client.http_client.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=SHEETS_MAX_WORKERS))
+    return new_client
+
+
+async def ensure_headers(worksheet):
+    # Проверяем, есть ли заголовки, и создаём их, если их нет
+    headers = await sheets_call(worksheet.row_values, 1, priority=PRIORITY_INTERACTIVE)
+    if not headers or headers[0] != "Статья расходов":
+        await sheets_call(worksheet.insert_row, ["Статья расходов", "Стоимость, AMD"], index=1, priority=PRIORITY_INTERACTIVE)
+
+
+async def connect_sheets():
+    # Подключаемся к таблице в фоне, повторяя попытки с нарастающей паузой, пока не получится
+    global client
+    # Основной лист в режиме sqlite работает из базы, не дожидаясь таблицы
+    await open_local_ledger(ledgers[DEFAULT_SHEET])
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            if client is None:
+                started = time.perf_counter()
+                client = await sheets_call(open_sheets, priority=PRIORITY_INTERACTIVE)
+                sheets_connected.set()
+                startup_timings["sheets_connect"] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            await open_ledger(ledgers[DEFAULT_SHEET])
+            startup_timings["ledger_load"] = time.perf_counter() - started
+            break
+        except Exception as e:
+            delay = min(2 ** attempt, SHEETS_CONNECT_MAX_DELAY)
+            logging.error(f"Не удалось подключиться к Google Sheets (попытка {attempt}), повтор через {delay:.0f} с: {e}")
+            await asyncio.sleep(delay)
+
+    startup_timings["total"] = time.perf_counter() - _import_started
+    phases = ", ".join(f"{name} {seconds:.2f} с" for name, seconds in startup_timings.items())
+    logging.info(f"Бот готов (попыток подключения к Sheets: {attempt}): {phases}")
+
+
+# Приоритеты запросов к Sheets: чем меньше число, тем раньше запрос уходит в API
+PRIORITY_INTERACTIVE = 0  # Запись трат пользователя, первая загрузка таблицы
+PRIORITY_NORMAL = 1  # Команды пользователя, которым нужна таблица
+PRIORITY_BACKGROUND = 2  # Ресинхронизация, создание листа на месяц, отчёты
+
+# Методы gspread, которые расходуют квоту на запись; остальные считаются чтением
+SHEETS_WRITE_METHODS = {"append_row", "append_rows", "insert_row", "update", "batch_update", "add_worksheet"}
+# Ответы API, после которых запрос имеет смысл повторить
+SHEETS_RETRY_CODES = {429, 500, 502, 503, 504}
+# Записи, которые можно безопасно повторить: update пишет те же значения в тот же диапазон.
+# Остальные (append_rows, insert_row, add_worksheet) при повторе после 5xx или обрыва могут продублироваться —
+# их повторяем только после 429 или если соединение так и не было установлено
+SHEETS_IDEMPOTENT_WRITES = {"update"}
+
+
+# Ведро токенов: rate_per_minute запросов в минуту с запасом на всплеск такого же размера (или capacity)
+class TokenBucket:
+    def __init__(self, rate_per_minute, capacity=None):
+        self.capacity = max(capacity or rate_per_minute, 1)
+        self.rate = max(rate_per_minute, 1) / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        # Сколько секунд ждать до следующего токена (0 — можно идти сразу)
+        self.refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def drain(self):
+        # API ответил 429 — считаем, что квота на ближайшее время исчерпана
+        self.refill()
+        self.tokens = min(self.tokens, 0)
+
+
+class SheetsRequest:
+    def __init__(self, func, args, kwargs, timeout, future):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.timeout = timeout
+        self.future = future
+        self.attempt = 0
+
+
+# Единая очередь запросов к Google Sheets: квоты на чтение и запись, приоритеты и повторы с паузой
+class SheetsScheduler:
+    def __init__(self, reads_per_minute, writes_per_minute):
+        self.buckets = {"read": TokenBucket(reads_per_minute), "write": TokenBucket(writes_per_minute)}
+        self.queues = {}  # Создаются при первом вызове, внутри работающего цикла событий
+        self.dispatchers = []
+        self.sequence = itertools.count()
+        self.depth = Counter()  # (чтение/запись, приоритет) -> сколько запросов ждёт в очереди
+        self.in_flight = 0
+        self.calls = 0
+        self.retries = 0
+        self.throttle_events = 0  # Сколько раз API ответил 429
+        self.errors = 0
+
+    def ensure_started(self):
+        if not self.dispatchers:
+            for kind in self.buckets:
+                self.queues[kind] = asyncio.PriorityQueue()
+                self.dispatchers.append(asyncio.create_task(self.dispatch(kind)))
+
+    async def call(self, func, *args, priority=PRIORITY_NORMAL, timeout=SHEETS_TIMEOUT, **kwargs):
+        self.ensure_started()
+        kind = "write" if getattr(func, "__name__", "") in SHEETS_WRITE_METHODS else "read"
+        request = SheetsRequest(func, args, kwargs, timeout, asyncio.get_running_loop().create_future())
+        self.enqueue(kind, priority, request)
+        return await request.future
+
+    def enqueue(self, kind, priority, request):
+        self.depth[(kind, priority)] += 1
+        self.queues[kind].put_nowait((priority, next(self.sequence), request))
+
+    async def dispatch(self, kind):
+        queue = self.queues[kind]
+        bucket = self.buckets[kind]
+        while True:
+            item = await queue.get()
+            delay = bucket.wait_time()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = bucket.wait_time()
+            bucket.take()
+            # Пока ждали токен, мог прийти запрос важнее — берём из очереди самый приоритетный
+            queue.put_nowait(item)
+            priority, _, request = queue.get_nowait()
+            self.depth[(kind, priority)] -= 1
+            if request.future.done():
+                continue
+            asyncio.create_task(self.execute(kind, priority, request))
+
+    async def execute(self, kind, priority, request):
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        self.calls += 1
+        method = getattr(request.func, "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            future = loop.run_in_executor(sheets_executor, functools.partial(request.func, *request.args, **request.kwargs))
+            result = await asyncio.wait_for(future, request.timeout)
+        except Exception as e:
+            sheets_call_seconds.observe(method, value=time.perf_counter() - started)
+            code = sheets_error_code(e)
+            if kind == "read" or method in SHEETS_IDEMPOTENT_WRITES:
+                retryable = code in SHEETS_RETRY_CODES or isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+            else:
+                retryable = code == 429 or request_not_sent(e)
+            if retryable and request.attempt < SHEETS_MAX_RETRIES and not request.future.done():
+                sheets_calls.inc(method, "retry")
+                request.attempt += 1
+                self.retries += 1
+                if code == 429:
+                    self.throttle_events += 1
+                    self.buckets[kind].drain()
+                # Экспоненциальная пауза с полным джиттером
+                delay = random.uniform(0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2 ** (request.attempt - 1)))
+                logging.warning(f"Sheets {request.func.__name__}: ошибка {code or type(e).__name__}, повтор {request.attempt}/{SHEETS_MAX_RETRIES} через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                self.enqueue(kind, priority, request)
+                return
+            sheets_calls.inc(method, "error")
+            self.errors += 1
+            if not request.future.done():
+                request.future.set_exception(e)
+            return
+        finally:
+            self.in_flight -= 1
+        sheets_call_seconds.observe(method, value=time.perf_counter() - started)
+        sheets_calls.inc(method, "ok")
+        if not request.future.done():
+            request.future.set_result(result)
+
+
+def sheets_error_code(error):
+    # HTTP-код ответа Google Sheets из исключения gspread (None — не ответ API)
+    if isinstance(error, gspread.exceptions.APIError):
+        code = getattr(error, "code", None)
+        if code is None and getattr(error, "response", None) is not None:
+            code = error.response.status_code
+        return code
+    return None
 
-# Проверяем, есть ли заголовки, и создаём их, если их нет
-headers = sheet.row_values(1)
-if not headers or headers[0] != "Статья расходов":
-    sheet.insert_row(["Статья расходов", "Стоимость, AMD"], index=1)
 
-cached_budget = None  # Переменная для хранения лимита
-last_budget_update = None  # Время последнего обновления
+def request_not_sent(error):
+    # Соединение с API не установлено — запрос точно не дошёл до сервера, и повтор записи не создаст дубль
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        reason = getattr(error.args[0], "reason", error.args[0])  # MaxRetryError -> NewConnectionError
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    return False
+
+
+sheets_scheduler = SheetsScheduler(SHEETS_READS_PER_MINUTE, SHEETS_WRITES_PER_MINUTE)
+
+
+def sheets_owner(func):
+    # Таблица, к которой относится вызов: запись в любой её лист делает устаревшими все чтения из неё
+    target = getattr(func, "__self__", None)
+    spreadsheet = getattr(target, "spreadsheet", target)
+    return getattr(spreadsheet, "id", None) or id(spreadsheet)
+
+
+# Одинаковые одновременные чтения выполняются один раз: остальные ждут тот же запрос,
+# а готовый результат ещё SHEETS_READ_FRESHNESS секунд отдаётся без обращения к API
+class SingleFlight:
+    def __init__(self, freshness):
+        self.freshness = freshness
+        self.entries = {}  # ключ -> (future, поколение таблицы, объект gspread — держим его, пока жив ключ с его id)
+        self.finished_at = {}  # ключ -> когда пришёл результат
+        self.generations = Counter()  # таблица -> сколько раз в неё писали
+        self.shared = 0
+
+    def invalidate(self, owner):
+        # Вызывается до и после каждой записи: чтения, начатые раньше, больше никому не отдаются
+        self.generations[owner] += 1
+
+    def fresh(self, key, owner):
+        entry = self.entries.get(key)
+        if entry is None or entry[1] != self.generations[owner]:
+            return None
+        future = entry[0]
+        if not future.done():
+            return future
+        if future.cancelled() or future.exception() is not None:
+            return None
+        return future if time.monotonic() - self.finished_at.get(key, 0) <= self.freshness else None
+
+    async def call(self, key, owner, method, fetch, target=None):
+        future = self.fresh(key, owner)
+        if future is not None:
+            self.shared += 1
+            sheets_reads_shared.inc(method)
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(fetch())
+        self.entries[key] = (future, self.generations[owner], target)
+        future.add_done_callback(lambda _: self.finished(key, future))
+        return await asyncio.shield(future)
+
+    def finished(self, key, future):
+        self.finished_at[key] = time.monotonic()
+        # Не копим старые результаты: через окно свежести они уже никому не нужны
+        expired = time.monotonic() - self.freshness
+        for old_key in [old_key for old_key, at in self.finished_at.items() if at < expired]:
+            del self.finished_at[old_key]
+            if self.entries.get(old_key, (None,))[0] is not None and self.entries[old_key][0].done():
+                del self.entries[old_key]
+
+
+sheets_reads = SingleFlight(SHEETS_READ_FRESHNESS)
+
+metrics.Gauge(
+    "cashtrack_sheets_queue_depth", "Запросы к Google Sheets в очереди", ("kind", "priority"),
+    collect=lambda: {(kind, str(priority)): depth for (kind, priority), depth in sheets_scheduler.depth.items()},
+)
+metrics.Gauge("cashtrack_sheets_in_flight", "Выполняющиеся запросы к Google Sheets", collect=lambda: {(): sheets_scheduler.in_flight})
+
+
+async def sheets_call(func, *args, priority=PRIORITY_NORMAL, timeout=SHEETS_TIMEOUT, **kwargs):
+    # Все вызовы gspread идут через планировщик: квоты, приоритеты, повторы, пул потоков и таймаут на попытку
+    method = getattr(func, "__name__", "")
+    owner = sheets_owner(func)
+    with profiling.span(f"sheets.{method}"):
+        if method in SHEETS_WRITE_METHODS:
+            sheets_reads.invalidate(owner)
+            try:
+                return await sheets_scheduler.call(func, *args, priority=priority, timeout=timeout, **kwargs)
+            finally:
+                sheets_reads.invalidate(owner)
+
+        # Результат чтения общий для всех ожидающих — вызывающий код не должен его изменять
+        target = getattr(func, "__self__", func)  # Объект gspread, а для обычных функций — сама функция
+        key = (owner, id(target), method, repr(args), repr(sorted(kwargs.items())))
+        return await sheets_reads.call(
+            key, owner, method,
+            lambda: sheets_scheduler.call(func, *args, priority=priority, timeout=timeout, **kwargs),
+            target=target,
+        )
+
+
+# Таблица трат начинается с A20 (заголовок), сами траты — с 21-й строки
+EXPENSES_TABLE_RANGE = "A20:C"
+EXPENSES_FIRST_ROW = 21
+
+# Таблица читается страницами по SHEETS_PAGE_ROWS строк: память и размер ответа не растут вместе с листом
+SHEETS_PAGE_ROWS = int(os.getenv("SHEETS_PAGE_ROWS", "10000"))
+HEADER_RANGE = f"1:{EXPENSES_FIRST_ROW - 1}"  # Шапка листа целиком: лимиты, B17/B18 и прочие настройки
+
+# Как часто перечитывать таблицу целиком, чтобы подхватить ручные правки (в минутах, 0 — не перечитывать)
+LEDGER_RESYNC_MINUTES = int(os.getenv("LEDGER_RESYNC_MINUTES", "15"))
+
+# Новые траты копятся не дольше WRITE_BATCH_WINDOW секунд (или до WRITE_BATCH_SIZE строк) и пишутся одним запросом
+WRITE_BATCH_WINDOW = float(os.getenv("WRITE_BATCH_WINDOW", "0.5"))
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "50"))
+
+# Режим хранения: "sheets" — только Google Таблица, "sqlite" — локальная база как основное хранилище с репликацией в таблицу
+STORAGE_MODE = os.getenv("STORAGE_MODE", "sheets")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "expenses.db")
+REPLICATION_RETRY_SECONDS = float(os.getenv("REPLICATION_RETRY_SECONDS", "30"))  # Пауза между попытками, если таблица недоступна
+
+# История по месячным листам ГГГГ-ММ: список листов кэшируется, прошедшие месяцы хранятся на диске
+HISTORY_CACHE_DIR = os.getenv("HISTORY_CACHE_DIR", "history_cache")
+HISTORY_WORKSHEETS_TTL_MINUTES = float(os.getenv("HISTORY_WORKSHEETS_TTL_MINUTES", "60"))  # Как долго верить списку листов
+MONTH_SHEET_TITLE = re.compile(r"^\d{4}-\d{2}$")
+
+# Снимок зеркала для тёплого перезапуска: колонки трат, суммы по дням и категориям, шапка и дневные лимиты чатов.
+# При старте бот поднимается из снимка и дочитывает из таблицы только строки, добавленные после него
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")  # Пустая строка — снимки выключены
+SNAPSHOT_MINUTES = float(os.getenv("SNAPSHOT_MINUTES", "5"))  # Как часто сохранять снимок, если зеркало менялось
+SNAPSHOT_MAGIC = b"CTSNAP"
+SNAPSHOT_VERSION = 1
+# Заголовок файла: магия, версия формата, трат, строк листа, сумм по (категория, день), длина JSON в конце.
+# Дальше без разбора: amounts (d), days (i), category_ids (i), суммы — категории (i), дни (i), итоги (d), JSON
+SNAPSHOT_HEADER = struct.Struct("<6sHIIII")
+
+# Массовый ввод трат (несколько строк в сообщении или CSV-файл) и выгрузка /export
+IMPORT_MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", "5000"))  # Сколько трат можно прислать за раз
+EXPORT_CHUNK_SIZE = 64 * 1024  # По сколько байт CSV отдаётся в Telegram при выгрузке
+
+
+async def iter_sheet_pages(worksheet, priority=PRIORITY_NORMAL, first_row=EXPENSES_FIRST_ROW, header=False):
+    # Страницы таблицы трат (A:C по SHEETS_PAGE_ROWS строк) одна за другой.
+    # С header=True первой страницей отдаётся шапка — она читается тем же запросом, что и первая страница трат.
+    # API отрезает пустые строки в конце диапазона, поэтому короткая страница ещё не конец листа: пустые строки
+    # посреди листа (например, удалённые траты) возвращаются перед следующей страницей, чтобы номера строк
+    # не съезжали. Конец таблицы — только пустая страница
+    start = first_row
+    blank = 0  # Сколько пустых строк отрезано в конце предыдущей страницы
+    while True:
+        page_range = f"A{start}:C{start + SHEETS_PAGE_ROWS - 1}"
+        if header:
+            head, page = await sheets_call(worksheet.batch_get, [HEADER_RANGE, page_range], priority=priority)
+            yield list(head)
+            header = False
+        else:
+            page = await sheets_call(worksheet.get, page_range, priority=priority)
+        if not page:
+            return
+        yield [[] for _ in range(blank)] + list(page)
+        blank = SHEETS_PAGE_ROWS - len(page)
+        start += SHEETS_PAGE_ROWS
+
 
-def get_daily_budget_limit():
-    global cached_budget, last_budget_update
+def parse_expense_row(row):
+    # Строка таблицы -> (категория, сумма, дата); None для пустых и нечисловых строк
+    if len(row) < 3:
+        return None
     try:
-        # Используем фейковую дату, если она установлена
-        current_date = datetime.strptime(fake_date, "%Y-%m-%d") if fake_date else datetime.now()
-        current_date_str = current_date.strftime("%Y-%m-%d")
-        current_month = current_date.strftime("%Y-%m")
+        amount = parse_amount(row[1])
+    except ValueError:
+        return None
+    return row[0].strip(), amount, row[2].strip()
+
+
+async def iter_expense_rows(worksheet, priority=PRIORITY_NORMAL, first_row=EXPENSES_FIRST_ROW):
+    # Разобранные траты (категория, сумма, дата) по одной, постранично: в памяти не больше одной страницы
+    async for page in iter_sheet_pages(worksheet, priority, first_row):
+        for row in page:
+            expense = parse_expense_row(row)
+            if expense is not None:
+                yield expense
+
+
+def format_amount(amount):
+    # Приводим сумму к тому виду, в котором её отдаёт API при чтении листа
+    return str(int(amount)) if float(amount).is_integer() else str(amount)
+
+
+def parse_amount(raw):
+    # Сумма из таблицы: "1 500" / "1,500" -> 1500.0
+    return float(str(raw).strip().replace(",", "").replace(" ", ""))
+
+
+@functools.lru_cache(maxsize=4096)
+def day_ordinal(date):
+    # "YYYY-MM-DD" -> номер дня; даты в таблице повторяются, поэтому разбор кэшируется
+    return date_type.fromisoformat(date).toordinal()
+
+
+# Префиксные суммы по дням: сумма за любой диапазон дат — два бинарных поиска
+class PrefixSums:
+    def __init__(self):
+        self.days = []  # Номера дней с тратами, по возрастанию
+        self.totals = []  # Накопленная сумма по этот день включительно
+
+    @classmethod
+    def from_totals(cls, day_totals):
+        index = cls()
+        running = 0
+        for day in sorted(day_totals):
+            running += day_totals[day]
+            index.days.append(day)
+            index.totals.append(running)
+        return index
+
+    def add(self, day, amount):
+        position = bisect_left(self.days, day)
+        if position == len(self.days) or self.days[position] != day:
+            self.days.insert(position, day)
+            self.totals.insert(position, self.total_before(position))
+        # Обычно это трата за последний день — правится один элемент; задним числом — весь хвост
+        for i in range(position, len(self.totals)):
+            self.totals[i] += amount
+
+    def total_before(self, position):
+        return self.totals[position - 1] if position else 0
+
+    def sum(self, first_day, last_day):
+        low, high = bisect_left(self.days, first_day), bisect_right(self.days, last_day)
+        return self.total_before(high) - self.total_before(low)
+
+    def daily(self, first_day, last_day):
+        # [(номер дня, сумма за день)] для дней с тратами внутри диапазона
+        low, high = bisect_left(self.days, first_day), bisect_right(self.days, last_day)
+        return [(self.days[i], self.totals[i] - self.total_before(i)) for i in range(low, high)]
+
+
+@functools.lru_cache(maxsize=1024)
+def month_of(day):
+    # Номер дня -> "YYYY-MM"
+    date = date_type.fromordinal(day)
+    return f"{date.year:04d}-{date.month:02d}"
+
+
+# Траты по колонкам: суммы, номера дней и номера категорий в компактных массивах, каждая строка разбирается один раз
+class ExpenseColumns:
+    def __init__(self):
+        self.amounts = array("d")
+        self.days = array("i")  # date.toordinal()
+        self.category_ids = array("i")
+        self.categories = []  # Номер категории -> название
+        self.category_numbers = {}  # Название -> номер
+        self.sheet_rows = 0  # Сколько строк листа прочитано, включая пустые и битые
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def category_id(self, name):
+        number = self.category_numbers.get(name)
+        if number is None:
+            number = self.category_numbers[name] = len(self.categories)
+            self.categories.append(name)
+        return number
+
+    def append(self, category, amount, day):
+        self.amounts.append(amount)
+        self.days.append(day)
+        self.category_ids.append(self.category_id(category))
+
+    @profiling.traced("parse.sheet_rows")
+    def add_rows(self, rows):
+        # Строки листа в том виде, что отдаёт API: пустые, нечисловые и строки без даты пропускаются
+        for row in rows:
+            self.sheet_rows += 1
+            expense = parse_expense_row(row)
+            if expense is None:
+                continue
+            category, amount, date = expense
+            try:
+                day = day_ordinal(date)
+            except ValueError:
+                continue
+            self.append(category, amount, day)
+
+
+ledger_generations = itertools.count()  # Номер каждого открытого зеркала: version нового зеркала снова начинается с нуля
+
+
+# Зеркало листа в памяти: таблица читается один раз, новые траты дописываются локально
+class Ledger:
+    def __init__(self, sheet_key):
+        self.key = sheet_key  # (ключ таблицы, название листа; None — первый лист)
+        self.generation = next(ledger_generations)
+        self.worksheet = None  # Подставляется в open_ledger
+        self.opening = None  # Задача открытия листа для чатов со своей таблицей
+        self.header = []  # Строки 1–20 листа (лимиты, B17/B18) в том виде, что отдаёт API
+        self.expenses = ExpenseColumns()
+        self.loaded_at = None
+        self.ready = asyncio.Event()  # Выставляется после первой загрузки таблицы
+        self.version = 0  # Растёт при каждом изменении зеркала — по нему инвалидируется кэш графиков
+        self.write_queue = asyncio.Queue()  # (строки, future) в ожидании записи; None — сигнал остановки
+        self.in_flight = set()  # future строк, уже отданных в append_rows: от них отказаться нельзя
+        # Загрузка листа и запись новых трат не пересекаются: иначе строки, записанные во время чтения страниц,
+        # пропали бы из зеркала, когда load подменит колонки целиком
+        self.sync_lock = asyncio.Lock()
+        self.writer_task = None
+        # Накопительные суммы: обновляются за O(1) на каждую трату, пересчитываются только при загрузке
+        self.day_totals = {}  # Номер дня -> сумма за день
+        self.month_totals = {}  # "YYYY-MM" -> сумма за месяц
+        self.month_category_totals = {}  # "YYYY-MM" -> {категория: сумма}
+        self.day_index = PrefixSums()  # Суммы за произвольный диапазон дат
+        self.category_index = {}  # Категория -> PrefixSums
+        self.from_snapshot = False  # Зеркало поднято из снимка — при открытии листа дочитываем только хвост
+        self.saved_budgets = {}  # chat_id -> (дневной лимит, дата) из снимка, ещё не забранные чатами
+        self.snapshot_version = 0  # Версия зеркала в последнем сохранённом снимке
+
+    async def load(self, priority=PRIORITY_NORMAL):
+        async with self.sync_lock:
+            await self.load_pages(priority)
+
+    async def load_pages(self, priority):
+        # Полная загрузка листа постранично — при старте и при ресинхронизации.
+        # Каждая страница сразу разбирается в колонки, сырые строки дальше не хранятся
+        if self.from_snapshot:
+            if await self.load_tail(priority):
+                self.from_snapshot = False
+                return
+            self.from_snapshot = False
+            logging.warning(f"Лист {self.key} изменился после снимка — загружаем его целиком")
+        header = None
+        columns = ExpenseColumns()
+        async for page in iter_sheet_pages(self.worksheet, priority, header=True):
+            if header is None:
+                header = page
+            else:
+                columns.add_rows(page)
+        self.set_columns(header, columns)
+        logging.info(f"Таблица загружена в память: {len(columns)} трат")
+
+    def set_values(self, values):
+        # Лист целиком (шапка + траты с 21-й строки), например из кэша истории на диске
+        columns = ExpenseColumns()
+        columns.add_rows(values[EXPENSES_FIRST_ROW - 1:])
+        self.set_columns(values[:EXPENSES_FIRST_ROW - 1], columns)
+
+    async def load_tail(self, priority=PRIORITY_NORMAL):
+        # Дочитываем строки, появившиеся после снимка, вместе с шапкой — обычно это два запроса (второй — пустая страница).
+        # Первой перечитываем последнюю трату снимка: если на её месте другое, лист правили вручную
+        expenses = self.expenses
+        first_row = EXPENSES_FIRST_ROW + expenses.sheet_rows
+        last = None
+        if len(expenses):
+            last = (expenses.categories[expenses.category_ids[-1]], expenses.amounts[-1], expenses.days[-1])
+            first_row -= 1
+        header = None
+        rows = []
+        async for page in iter_sheet_pages(self.worksheet, priority, first_row=first_row, header=True):
+            if header is None:
+                header = page
+            else:
+                rows.extend(page)
+
+        if last is not None:
+            check = parse_expense_row(rows[0]) if rows else None
+            if check is None or (check[0], check[1]) != last[:2] or check[2] != date_type.fromordinal(last[2]).isoformat():
+                return False
+            rows = rows[1:]
+
+        known = len(expenses)
+        expenses.add_rows(rows)
+        for i in range(known, len(expenses)):
+            self.add_to_aggregates(expenses.categories[expenses.category_ids[i]], expenses.amounts[i], expenses.days[i])
+        self.header = self.padded_header(header)
+        self.loaded_at = datetime.now()
+        self.version += 1
+        logging.info(f"Лист {self.key} дочитан после снимка: {len(expenses) - known} новых трат")
+        return True
+
+    def padded_header(self, header):
+        # Шапку добиваем до 20 строк, чтобы номера строк совпадали с листом
+        return header + [[] for _ in range(EXPENSES_FIRST_ROW - 1 - len(header))]
+
+    def set_columns(self, header, columns, category_days=None):
+        # category_days — готовые суммы по (категория, день) из снимка; иначе считаются по колонкам
+        self.header = self.padded_header(header)
+        self.expenses = columns
+        self.loaded_at = datetime.now()
+        self.version += 1
+        if category_days is None:
+            self.rebuild_aggregates()
+        else:
+            self.set_aggregates(category_days)
+        self.ready.set()
+
+    async def wait_ready(self):
+        # Таблица загружается в фоне после старта — ждём её, но не дольше таймаута запроса
+        await asyncio.wait_for(self.ready.wait(), SHEETS_TIMEOUT)
+
+    @profiling.traced("aggregate.rebuild")
+    def rebuild_aggregates(self):
+        # Один проход по колонкам с целочисленными ключами; месяцы и названия категорий — уже по итогам
+        expenses = self.expenses
+        category_days = [{} for _ in expenses.categories]  # Номер категории -> {номер дня: сумма}
+        for amount, day, category_id in zip(expenses.amounts, expenses.days, expenses.category_ids):
+            days = category_days[category_id]
+            days[day] = days.get(day, 0) + amount
+        self.set_aggregates(category_days)
+
+    def set_aggregates(self, category_days):
+        # Номер категории -> {номер дня: сумма}. Таких сумм немного даже на сотнях тысяч трат,
+        # поэтому остальные индексы строятся по ним, а не по колонкам
+        expenses = self.expenses
+        self.day_totals = {}
+        self.month_totals = {}
+        self.month_category_totals = {}
+        for category, days in zip(expenses.categories, category_days):
+            for day, total in days.items():
+                month = month_of(day)
+                self.day_totals[day] = self.day_totals.get(day, 0) + total
+                self.month_totals[month] = self.month_totals.get(month, 0) + total
+                categories = self.month_category_totals.setdefault(month, {})
+                categories[category] = categories.get(category, 0) + total
+
+        self.day_index = PrefixSums.from_totals(self.day_totals)
+        self.category_index = {
+            category: PrefixSums.from_totals(days) for category, days in zip(expenses.categories, category_days) if days
+        }
+
+    def add_to_aggregates(self, category, amount, day):
+        month = month_of(day)
+        self.day_totals[day] = self.day_totals.get(day, 0) + amount
+        self.month_totals[month] = self.month_totals.get(month, 0) + amount
+        categories = self.month_category_totals.setdefault(month, {})
+        categories[category] = categories.get(category, 0) + amount
+        self.day_index.add(day, amount)
+        self.category_index.setdefault(category, PrefixSums()).add(day, amount)
+
+    def add_to_mirror(self, category, amount, date):
+        day = day_ordinal(date)
+        self.expenses.append(category, float(amount), day)
+        self.expenses.sheet_rows += 1
+        self.add_to_aggregates(category, float(amount), day)
+        self.version += 1
+
+    async def append_expense(self, category, amount, date):
+        return await self.append_expenses([[category, amount, date]])
+
+    async def append_expenses(self, rows):
+        # Ставим строки в очередь на запись и ждём, пока они окажутся в Google Таблице: True — записаны.
+        # После подъёма из снимка зеркало готово раньше, чем подключена таблица, поэтому ждём не дольше таймаута.
+        # Строки, которые писатель ещё не взял, отменяем (TimeoutError — ничего не записано);
+        # уже отправленные отменить нельзя — они дойдут до таблицы сами, и тогда возвращаем False
+        future = asyncio.get_running_loop().create_future()
+        await self.write_queue.put((rows, future))
+        await asyncio.wait([future], timeout=SHEETS_TIMEOUT)
+        if future.done():
+            future.result()
+            return True
+        if future in self.in_flight:
+            future.add_done_callback(lambda done: done.cancelled() or done.exception())  # Ошибку записи уже залогировал flush
+            return False
+        future.cancel()
+        raise asyncio.TimeoutError()
+
+    def start_writer(self):
+        self.writer_task = asyncio.create_task(self.run_writer())
+
+    async def stop_writer(self):
+        # Дописываем всё, что осталось в очереди, и останавливаем писателя
+        if self.writer_task is not None:
+            await self.write_queue.put(None)
+            await self.writer_task
+            self.writer_task = None
+
+    async def run_writer(self):
+        # Собираем строки за короткое окно и отправляем их одним append_rows
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.write_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            batch_rows = len(item[0])
+            stopping = False
+            deadline = loop.time() + WRITE_BATCH_WINDOW
+            while batch_rows < WRITE_BATCH_SIZE:
+                try:
+                    item = await asyncio.wait_for(self.write_queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                batch_rows += len(item[0])
+            await self.flush(batch)
+            if stopping:
+                return
+
+    async def flush(self, batch):
+        async with self.sync_lock:
+            await self.send_batch(batch)
+
+    async def send_batch(self, batch):
+        batch = [item for item in batch if not item[1].done()]  # Не дождались записи — строки не отправляем
+        if not batch:
+            return
+        rows = [row for item_rows, _ in batch for row in item_rows]
+        futures = {future for _, future in batch}
+        self.in_flight |= futures
+        try:
+            await sheets_call(self.worksheet.append_rows, rows, table_range=EXPENSES_TABLE_RANGE, priority=PRIORITY_INTERACTIVE)
+        except Exception as e:
+            logging.error(f"Ошибка при записи {len(rows)} строк в таблицу: {e}")
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.in_flight -= futures
+
+        # Строки уже в таблице — применяем их к зеркалу и отпускаем ожидающие обработчики
+        for category, amount, date in rows:
+            self.add_to_mirror(category, amount, date)
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+        logging.info(f"Записано в таблицу одним запросом: {len(rows)} строк")
+
+    def cell(self, label):
+        # Значение ячейки шапки по A1-адресу (например, "B17")
+        row, col = gspread.utils.a1_to_rowcol(label)
+        if row > len(self.header) or col > len(self.header[row - 1]):
+            return ""
+        return self.header[row - 1][col - 1]
+
+    def setting(self, name):
+        # Значение из колонки B для строки шапки с подписью name в колонке A
+        for row in self.header:
+            if row and row[0] == name and len(row) > 1:
+                return row[1]
+        return None
+
+    def dump_snapshot(self, budgets):
+        # Снимок в формате SNAPSHOT_HEADER; суммы по дням берутся из индексов категорий
+        expenses = self.expenses
+        sum_categories, sum_days, sum_totals = array("i"), array("i"), array("d")
+        for category, index in self.category_index.items():
+            for day, total in index.daily(1, date_type.max.toordinal()):
+                sum_categories.append(expenses.category_numbers[category])
+                sum_days.append(day)
+                sum_totals.append(total)
+        meta = json.dumps({
+            "key": list(self.key),
+            "byteorder": sys.byteorder,
+            "saved_at": datetime.now().isoformat(timespec="seconds"),
+            "header": self.header,
+            "categories": expenses.categories,
+            "budgets": {str(chat_id): list(budget) for chat_id, budget in budgets.items()},
+        }, ensure_ascii=False).encode()
+        return b"".join([
+            SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(expenses), expenses.sheet_rows, len(sum_totals), len(meta)),
+            expenses.amounts.tobytes(), expenses.days.tobytes(), expenses.category_ids.tobytes(),
+            sum_categories.tobytes(), sum_days.tobytes(), sum_totals.tobytes(),
+            meta,
+        ])
+
+    def restore_snapshot(self, buffer):
+        # buffer — файл снимка, отображённый в память: массивы копируются из него целиком, строки не разбираются
+        magic, version, rows, sheet_rows, sums, meta_size = SNAPSHOT_HEADER.unpack_from(buffer)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"неизвестный формат снимка {magic!r} версии {version}")
+        offset = SNAPSHOT_HEADER.size
+        columns = ExpenseColumns()
+        columns.amounts, offset = read_array(buffer, offset, "d", rows)
+        columns.days, offset = read_array(buffer, offset, "i", rows)
+        columns.category_ids, offset = read_array(buffer, offset, "i", rows)
+        sum_categories, offset = read_array(buffer, offset, "i", sums)
+        sum_days, offset = read_array(buffer, offset, "i", sums)
+        sum_totals, offset = read_array(buffer, offset, "d", sums)
+        meta = json.loads(buffer[offset:offset + meta_size].decode())
+        if meta["key"] != list(self.key) or meta["byteorder"] != sys.byteorder:
+            raise ValueError(f"снимок сделан для листа {meta['key']} ({meta['byteorder']})")
+
+        columns.sheet_rows = sheet_rows
+        columns.categories = meta["categories"]
+        columns.category_numbers = {name: number for number, name in enumerate(columns.categories)}
+        category_days = [{} for _ in columns.categories]
+        for category_id, day, total in zip(sum_categories, sum_days, sum_totals):
+            category_days[category_id][day] = total
+        self.set_columns(meta["header"], columns, category_days)
+        self.from_snapshot = True
+        self.saved_budgets = {int(chat_id): tuple(budget) for chat_id, budget in meta["budgets"].items()}
+        self.snapshot_version = self.version
+        return meta["saved_at"]
+
+
+def read_array(buffer, offset, typecode, count):
+    # count элементов typecode с позиции offset -> (array, позиция после них)
+    values = array(typecode)
+    end = offset + values.itemsize * count
+    if end > len(buffer):
+        raise ValueError("снимок обрезан")
+    with memoryview(buffer)[offset:end] as chunk:
+        values.frombytes(chunk)
+    return values, end
+
+
+# Локальная база как источник истины: траты пишутся в SQLite, а в таблицу уходят фоновой репликацией
+class SqliteLedger(Ledger):
+    def __init__(self, sheet_key, path):
+        super().__init__(sheet_key)
+        # Все обращения к базе идут через один поток: цикл событий не ждёт диск, а запросы выполняются по очереди
+        self.db = None
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.db_opened = self.db_executor.submit(self.open_db, path)
+        self.replicate_event = asyncio.Event()
+        self.stopping = False
+
+    def open_db(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS expenses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                category TEXT NOT NULL,
+                amount REAL NOT NULL,
+                date TEXT NOT NULL,
+                replicated INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses (date);
+            CREATE INDEX IF NOT EXISTS idx_expenses_category ON expenses (category);
+            CREATE INDEX IF NOT EXISTS idx_expenses_pending ON expenses (id) WHERE replicated = 0;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        """)
+        # Базы, заполненные до появления отметки о переносе, считаем перенесёнными: повторный перенос задвоил бы траты
+        self.db.execute("INSERT OR IGNORE INTO meta (key, value) SELECT 'imported', '1' WHERE EXISTS (SELECT 1 FROM expenses)")
+        self.db.commit()
+
+    async def run_db(self, func, *args):
+        await asyncio.wrap_future(self.db_opened)  # Если база не открылась — здесь та же ошибка
+        return await asyncio.get_running_loop().run_in_executor(self.db_executor, func, *args)
+
+    def save_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+        self.db.commit()
+
+    def saved_meta(self, key):
+        saved = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(saved[0]) if saved is not None else None
+
+    async def fetch_header(self, priority=PRIORITY_NORMAL):
+        # Шапка листа (лимиты, B17/B18) из таблицы до раздела "Daily expenses", как у листа без базы;
+        # копия сохраняется в базе на время недоступности таблицы
+        header = await sheets_call(self.worksheet.get, HEADER_RANGE, priority=priority)
+        header = header_through_marker([list(row) for row in header], self.key)
+        await self.run_db(self.save_meta, "header", header)
+        return header
+
+    async def open_local(self):
+        # Траты и сохранённая шапка из базы: лист готов к чтению и записи без Google Sheets.
+        # Пока траты из таблицы не перенесены в базу (самый первый запуск), лист открывается через таблицу в open_ledger
+        header = await self.run_db(self.saved_meta, "header")
+        if header is None or not await self.run_db(self.saved_meta, "imported"):
+            return False
+        await self.load_columns(header)
+        return True
+
+    async def load(self, priority=PRIORITY_NORMAL):
+        try:
+            header = await self.fetch_header(priority)
+        except Exception as e:
+            header = await self.run_db(self.saved_meta, "header")
+            if header is None:
+                raise
+            logging.error(f"Таблица недоступна, используем сохранённую шапку листа: {e}")
+
+        # При первом запуске переносим в базу траты, которые уже есть в таблице
+        if not await self.run_db(self.saved_meta, "imported"):
+            await self.import_from_sheet(priority)
+        await self.load_columns(header)
+
+    async def load_columns(self, header):
+        # Чтение базы и запись новых трат не пересекаются, иначе трата попала бы в зеркало дважды
+        async with self.sync_lock:
+            columns = await self.run_db(self.read_columns)
+            self.set_columns(header, columns)
+        logging.info(f"Траты загружены из базы: {len(columns)} строк")
+
+    def read_columns(self):
+        # Строки из базы уже типизированы — в колонки без разбора строк
+        columns = ExpenseColumns()
+        for category, amount, date in self.db.execute("SELECT category, amount, date FROM expenses ORDER BY id"):
+            try:
+                columns.append(category, amount, day_ordinal(date))
+            except ValueError:
+                continue
+        return columns
+
+    async def import_from_sheet(self, priority=PRIORITY_NORMAL):
+        # Переносим потоком: в памяти не больше одной страницы. Весь перенос — одна транзакция вместе с отметкой
+        # 'imported': если таблица отвалится посередине, база останется пустой и перенос повторится при следующей загрузке
+        imported = 0
+        rows = []
+        try:
+            async for expense in iter_expense_rows(self.worksheet, priority):
+                rows.append(expense)
+                if len(rows) >= SHEETS_PAGE_ROWS:
+                    await self.run_db(self.insert_expenses, rows, 1)
+                    imported += len(rows)
+                    rows = []
+            await self.run_db(self.insert_expenses, rows, 1)
+            imported += len(rows)
+            await self.run_db(self.save_meta, "imported", True)
+        except BaseException:
+            await asyncio.shield(self.run_db(self.rollback))
+            raise
+        logging.info(f"Перенесено из таблицы в базу: {imported} строк")
+
+    def insert_expenses(self, rows, replicated):
+        self.db.executemany("INSERT INTO expenses (category, amount, date, replicated) VALUES (?, ?, ?, ?)", [(*row, replicated) for row in rows])
+
+    def commit_expenses(self, rows):
+        self.insert_expenses(rows, 0)
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close_db(self):
+        self.db.close()
+
+    def pending_rows(self, limit):
+        return self.db.execute(
+            "SELECT id, category, amount, date FROM expenses WHERE replicated = 0 ORDER BY id LIMIT ?", (limit,),
+        ).fetchall()
+
+    def pending_count(self):
+        return self.db.execute("SELECT COUNT(*) FROM expenses WHERE replicated = 0").fetchone()[0]
+
+    def mark_replicated(self, ids):
+        self.db.executemany("UPDATE expenses SET replicated = 1 WHERE id = ?", [(row_id,) for row_id in ids])
+        self.db.commit()
+
+    async def append_expenses(self, rows):
+        # Запись в локальную базу — траты сохранены, в таблицу их отправит репликация
+        async with self.sync_lock:
+            await self.run_db(self.commit_expenses, rows)
+            for category, amount, date in rows:
+                self.add_to_mirror(category, amount, date)
+        self.replicate_event.set()
+        return True
+
+    async def stop_writer(self):
+        # Пытаемся дописать в таблицу всё, что ещё не реплицировано; остальное уйдёт после перезапуска
+        if self.writer_task is not None:
+            self.stopping = True
+            self.replicate_event.set()
+            await self.writer_task
+            self.writer_task = None
+        await self.run_db(self.close_db)
+        self.db_executor.shutdown()
+
+    async def attach_worksheet(self):
+        # Лист, открытый из базы, подключается к таблице, как только она доступна; шапка обновляется из неё
+        if not sheets_connected.is_set():
+            raise ConnectionError("нет подключения к Google Sheets")
+        self.worksheet = await open_worksheet(self.key, PRIORITY_BACKGROUND)
+        self.header = self.padded_header(await self.fetch_header(PRIORITY_BACKGROUND))
+        self.version += 1
+        logging.info(f"Лист {self.key} подключён к таблице, репликация запущена")
+
+    async def run_writer(self):
+        # Репликация: отправляем неотправленные строки пачками, после сбоя повторяем через паузу
+        while True:
+            if self.worksheet is None:
+                try:
+                    await self.attach_worksheet()
+                except Exception as e:
+                    logging.error(f"Таблица недоступна, траты копятся в базе: {e}")
+                    if self.stopping:
+                        return
+                    await self.wait_for_rows(REPLICATION_RETRY_SECONDS)
+                    continue
+            pending = await self.run_db(self.pending_rows, WRITE_BATCH_SIZE)
+            if pending:
+                try:
+                    rows = [[category, amount, date] for _, category, amount, date in pending]
+                    await sheets_call(self.worksheet.append_rows, rows, table_range=EXPENSES_TABLE_RANGE, priority=PRIORITY_NORMAL)
+                except Exception as e:
+                    logging.error(f"Ошибка репликации в таблицу ({len(pending)} строк в очереди): {e}")
+                    if self.stopping:
+                        return
+                    await self.wait_for_rows(REPLICATION_RETRY_SECONDS)
+                    continue
+                await self.run_db(self.mark_replicated, [row[0] for row in pending])
+                logging.info(f"Реплицировано в таблицу: {len(pending)} строк")
+                continue
 
-        # Если лимит уже загружен сегодня, используем кэш
-        if cached_budget is not None and last_budget_update == current_date_str:
-            return cached_budget
+            if self.stopping:
+                return
+            await self.wait_for_rows(REPLICATION_RETRY_SECONDS)
+            # Даём накопиться соседним тратам, чтобы отправить их одним запросом
+            await asyncio.sleep(WRITE_BATCH_WINDOW)
 
-        # Запрашиваем данные из Google Sheets
-        values = sheet.get_all_values()
-        for row in values:
-            if row[0] == "Daily budget limit, AMD":
-                raw_value = row[1].strip().replace(" ", "").replace(",", ".")
-                budget = float(raw_value)
+    async def wait_for_rows(self, timeout):
+        self.replicate_event.clear()
+        try:
+            await asyncio.wait_for(self.replicate_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
-                # Пересчитываем бюджет с учётом фейковой даты
-                new_budget = recalculate_daily_budget(budget)
-                cached_budget = new_budget
-                last_budget_update = current_date_str
 
-                logging.info(f"Обновлённый дневной лимит: {cached_budget}")
-                return cached_budget
+DEFAULT_SHEET = (SPREADSHEET_NAME, None)
 
-    except Exception as e:
-        logging.error(f"Ошибка при получении бюджета: {e}")
-    return None
 
+def sqlite_path_for(sheet_key):
+    # Основная таблица живёт в SQLITE_PATH, остальные — в соседних файлах со своим суффиксом
+    if sheet_key == DEFAULT_SHEET:
+        return SQLITE_PATH
+    root, ext = os.path.splitext(SQLITE_PATH)
+    suffix = re.sub(r"[^\w-]", "_", "-".join(part for part in sheet_key if part))
+    return f"{root}-{suffix}{ext}"
 
-def create_new_month_sheet():
-    try:
-        # Текущая дата или фейковая дата
-        today = datetime.strptime(fake_date, "%Y-%m-%d") if fake_date else datetime.now()
-        new_sheet_title = today.strftime("%Y-%m")
 
-        # Проверяем, существует ли уже лист на новый месяц
-        if new_sheet_title in [sheet.title for sheet in client.open_by_key(SPREADSHEET_NAME).worksheets()]:
-            logging.info(f"Лист {new_sheet_title} уже существует.")
-            return
+def make_ledger(sheet_key):
+    if STORAGE_MODE == "sqlite":
+        return SqliteLedger(sheet_key, sqlite_path_for(sheet_key))
+    ledger = Ledger(sheet_key)
+    if SNAPSHOT_DIR:
+        load_snapshot(ledger)
+    return ledger
 
-        # Создаём новый лист
-        new_sheet = client.open_by_key(SPREADSHEET_NAME).add_worksheet(title=new_sheet_title, rows="100", cols="20")
 
-        # Копируем данные из основного листа до раздела "Daily expenses"
-        source_data = sheet.get_all_values()
-        for i, row in enumerate(source_data):
-            if "Daily expenses" in row:
-                end_index = i
-                break
+def snapshot_path_for(sheet_key):
+    name = re.sub(r"[^\w-]", "_", "-".join(part for part in sheet_key if part))
+    return os.path.join(SNAPSHOT_DIR, f"{name}.snap")
 
-        # Вставляем скопированные данные в новый лист
-        new_sheet.update("A1", source_data[:end_index + 1])
-        logging.info(f"Создан новый лист: {new_sheet_title} с копией данных до 'Daily expenses'")
 
+def load_snapshot(ledger):
+    # Тёплый старт: зеркало готово сразу, таблица дочитывается в open_ledger после подключения.
+    # SQLite-режиму снимок не нужен — база и так локальная
+    path = snapshot_path_for(ledger.key)
+    if not os.path.exists(path):
+        return
+    started = time.perf_counter()
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            saved_at = ledger.restore_snapshot(buffer)
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        logging.error(f"Ошибка при чтении снимка {path}, лист будет загружен целиком: {e}")
+        return
+    logging.info(
+        f"Зеркало листа {ledger.key} поднято из снимка от {saved_at}: {len(ledger.expenses)} трат "
+        f"за {time.perf_counter() - started:.3f} с"
+    )
+
+
+def write_snapshot(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)  # Атомарно: после падения на середине записи остаётся прошлый снимок
+
+
+async def save_snapshot(ledger):
+    # Сохраняем, только если зеркало изменилось с прошлого снимка и уже сверено с таблицей
+    if not SNAPSHOT_DIR or isinstance(ledger, SqliteLedger) or ledger.worksheet is None or ledger.from_snapshot:
+        return
+    if ledger.version == ledger.snapshot_version:
+        return
+    budgets = dict(ledger.saved_budgets)
+    for ctx in contexts.all():
+        if ctx.sheet == ledger.key and ctx.cached_budget is not None and not ctx.fake_date:
+            budgets[ctx.chat_id] = (ctx.cached_budget, ctx.last_budget_update)
+    version = ledger.version
+    data = ledger.dump_snapshot(budgets)
+    try:
+        await asyncio.to_thread(write_snapshot, snapshot_path_for(ledger.key), data)
+    except OSError as e:
+        logging.error(f"Ошибка при записи снимка листа {ledger.key}: {e}")
+        return
+    ledger.snapshot_version = version
+    logging.info(f"Снимок листа {ledger.key} сохранён: {len(ledger.expenses)} трат, {len(data)} байт")
+
+
+async def snapshot_loop():
+    while SNAPSHOT_DIR and SNAPSHOT_MINUTES > 0:
+        await asyncio.sleep(SNAPSHOT_MINUTES * 60)
+        for ledger in list(ledgers.values()):
+            await save_snapshot(ledger)
+
+
+# Загруженные листы: (ключ таблицы, лист) -> Ledger. Основной открывается при старте в connect_sheets
+ledgers = {DEFAULT_SHEET: make_ledger(DEFAULT_SHEET)}
+
+
+async def open_worksheet(sheet_key, priority=PRIORITY_INTERACTIVE):
+    spreadsheet_key, worksheet_title = sheet_key
+    spreadsheet = await sheets_call(client.open_by_key, spreadsheet_key, priority=priority)
+    if worksheet_title:
+        worksheet = await sheets_call(spreadsheet.worksheet, worksheet_title, priority=priority)
+    else:
+        worksheet = await sheets_call(spreadsheet.get_worksheet, 0, priority=priority)
+    await ensure_headers(worksheet)
+    return worksheet
+
+
+async def open_local_ledger(ledger):
+    # В режиме sqlite лист открывается из базы сразу, а к таблице его подключает репликация (SqliteLedger.run_writer)
+    if not isinstance(ledger, SqliteLedger) or not await ledger.open_local():
+        return False
+    ledger.start_writer()
+    return True
+
+
+async def open_ledger(ledger):
+    # Открываем лист, проверяем заголовки и загружаем его в память
+    if isinstance(ledger, SqliteLedger) and (ledger.ready.is_set() or await open_local_ledger(ledger)):
+        return
+    await asyncio.wait_for(sheets_connected.wait(), SHEETS_TIMEOUT)
+    ledger.worksheet = await open_worksheet(ledger.key)
+    await ledger.load(PRIORITY_INTERACTIVE)
+    ledger.start_writer()
+
+
+async def get_ledger(ctx):
+    # Лист чата открывается при первом обращении; остальные запросы ждут ту же загрузку
+    ledger = ledgers.get(ctx.sheet)
+    if ledger is None:
+        ledger = ledgers[ctx.sheet] = make_ledger(ctx.sheet)
+        ledger.opening = asyncio.ensure_future(open_ledger(ledger))
+    if ledger.opening is not None and not ledger.ready.is_set():
+        try:
+            await asyncio.wait_for(asyncio.shield(ledger.opening), SHEETS_TIMEOUT)
+        except Exception:
+            # Не удалось открыть — в следующий раз попробуем заново
+            if ledger.opening.done() and ledgers.get(ctx.sheet) is ledger:
+                del ledgers[ctx.sheet]
+            raise
+    await ledger.wait_ready()
+    if ctx.ledger is None and ctx.chat_id in ledger.saved_budgets:
+        # Дневной лимит из снимка: после перезапуска не пересчитываем его заново
+        ctx.cached_budget, ctx.last_budget_update = ledger.saved_budgets.pop(ctx.chat_id)
+    ctx.ledger = ledger
+    return ledger
+
+
+def sheet_for_chat(chat_id):
+    mapping = CHAT_SHEETS.get(str(chat_id))
+    if mapping is None:
+        return DEFAULT_SHEET
+    if isinstance(mapping, str):
+        return (mapping, None)
+    return (mapping.get("spreadsheet", SPREADSHEET_NAME), mapping.get("worksheet"))
+
+
+# Состояние бюджета одного чата: свой лист, кэш дневного лимита и фейковая дата
+class ChatContext:
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.sheet = sheet_for_chat(chat_id)
+        self.ledger = None  # Подставляется в get_ledger
+        self.cached_budget = None  # Кэш дневного лимита
+        self.last_budget_update = None  # Дата последнего обновления лимита
+        self.fake_date = None  # Фейковая дата (для тестов)
+        self.last_seen = time.monotonic()
+
+
+# Реестр контекстов чатов, разбитый на шарды: выгрузка простаивающих чатов обходит шарды по одному
+# и не держит цикл событий на всём реестре сразу
+class ContextRegistry:
+    def __init__(self, shards):
+        self.shards = [{} for _ in range(shards)]
+
+    def get(self, chat_id):
+        shard = self.shards[chat_id % len(self.shards)]
+        ctx = shard.get(chat_id)
+        if ctx is None:
+            ctx = shard[chat_id] = ChatContext(chat_id)
+        ctx.last_seen = time.monotonic()
+        return ctx
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def sheets_in_use(self):
+        return {ctx.sheet for shard in self.shards for ctx in shard.values()}
+
+    def all(self):
+        return [ctx for shard in self.shards for ctx in shard.values()]
+
+    async def evict_idle(self, max_idle):
+        now = time.monotonic()
+        evicted = 0
+        for shard in self.shards:
+            for chat_id in [chat_id for chat_id, ctx in shard.items() if now - ctx.last_seen > max_idle]:
+                del shard[chat_id]
+                evicted += 1
+            await asyncio.sleep(0)
+        return evicted
+
+
+contexts = ContextRegistry(CONTEXT_SHARDS)
+
+
+async def evict_idle_contexts_loop():
+    # Выгружаем чаты, которые давно не писали, и листы, которыми больше никто не пользуется
+    while True:
+        await asyncio.sleep(60)
+        try:
+            evicted = await contexts.evict_idle(CONTEXT_IDLE_MINUTES * 60)
+            in_use = contexts.sheets_in_use()
+            for key in [key for key, ledger in ledgers.items() if key != DEFAULT_SHEET and key not in in_use and ledger.opening is not None and ledger.opening.done()]:
+                ledger = ledgers.pop(key)
+                await ledger.stop_writer()
+                await save_snapshot(ledger)
+            if evicted:
+                logging.info(f"Выгружено простаивающих чатов: {evicted}, осталось: {len(contexts)}, листов в памяти: {len(ledgers)}")
+        except Exception as e:
+            logging.error(f"Ошибка при выгрузке простаивающих чатов: {e}")
+
+
+async def ledger_resync_loop():
+    # Периодически перечитываем таблицы, чтобы учесть правки, сделанные прямо в них
+    while LEDGER_RESYNC_MINUTES > 0:
+        await asyncio.sleep(LEDGER_RESYNC_MINUTES * 60)
+        for ledger in list(ledgers.values()):
+            if not ledger.ready.is_set() or ledger.worksheet is None:
+                continue
+            try:
+                await ledger.load(PRIORITY_BACKGROUND)
+            except Exception as e:
+                logging.error(f"Ошибка при ресинхронизации таблицы: {e}")
+
+
+# Месячные листы одной таблицы: открываем таблицу и читаем список листов один раз, прошедшие месяцы не перечитываем
+class MonthHistory:
+    def __init__(self, spreadsheet_key):
+        self.key = spreadsheet_key
+        self.spreadsheet = None
+        self.worksheets = {}  # Название листа -> лист
+        self.listed_at = None
+        self.archives = {}  # "ГГГГ-ММ" -> Ledger с разобранным прошедшим месяцем
+        self.lock = asyncio.Lock()
+        self.create_lock = asyncio.Lock()  # Создание листа на новый месяц
+
+    async def list_worksheets(self, refresh=False, priority=PRIORITY_BACKGROUND):
+        async with self.lock:
+            if self.spreadsheet is None:
+                self.spreadsheet = await sheets_call(client.open_by_key, self.key, priority=priority)
+            expired = self.listed_at is None or time.monotonic() - self.listed_at > HISTORY_WORKSHEETS_TTL_MINUTES * 60
+            if refresh or expired:
+                worksheets = await sheets_call(self.spreadsheet.worksheets, priority=priority)
+                self.worksheets = {worksheet.title: worksheet for worksheet in worksheets}
+                self.listed_at = time.monotonic()
+        return self.worksheets
+
+    def cache_path(self, month):
+        return os.path.join(HISTORY_CACHE_DIR, re.sub(r"[^\w-]", "_", self.key), f"{month}.json")
+
+    def read_cache(self, month):
+        try:
+            with open(self.cache_path(month), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.error(f"Ошибка при чтении кэша месяца {month}: {e}")
+            return None
+
+    def write_cache(self, month, archive):
+        # В кэше — строки листа в том же виде, что отдаёт API, поэтому читается он через set_values
+        expenses = archive.expenses
+        values = archive.header + [
+            [expenses.categories[category_id], format_amount(amount), date_type.fromordinal(day).isoformat()]
+            for amount, day, category_id in zip(expenses.amounts, expenses.days, expenses.category_ids)
+        ]
+        path = self.cache_path(month)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(values, f, ensure_ascii=False)
+            os.replace(path + ".tmp", path)  # Атомарно: недописанный файл не будет принят за кэш
+        except OSError as e:
+            logging.error(f"Ошибка при записи кэша месяца {month}: {e}")
+
+    def parse(self, month, values):
+        archive = Ledger((self.key, month))
+        archive.set_values(values)
+        return archive
+
+    async def load_month(self, month, priority=PRIORITY_NORMAL):
+        # Лист месяца читается постранично, как и основной (Ledger.load)
+        archive = Ledger((self.key, month))
+        archive.worksheet = self.worksheets[month]
+        await archive.load(priority)
+        return archive
+
+    async def load_months(self, months, current_month, priority=PRIORITY_NORMAL):
+        # Прошедшие месяцы — из памяти или с диска, остальные — из таблицы, все листы одновременно
+        archives = {}
+        missing = []
+        for month in months:
+            if month in self.archives:
+                archives[month] = self.archives[month]
+                continue
+            values = self.read_cache(month) if month < current_month else None
+            if values is not None:
+                archives[month] = self.archives[month] = self.parse(month, values)
+            else:
+                missing.append(month)
+
+        if missing:
+            loaded = await asyncio.gather(*(self.load_month(month, priority) for month in missing))
+            for month, archive in zip(missing, loaded):
+                archives[month] = archive
+                if month < current_month:
+                    # Прошедший месяц больше не меняется — сохраняем навсегда
+                    self.archives[month] = archive
+                    self.write_cache(month, archive)
+            logging.info(f"История: загружено листов из таблицы: {len(missing)}")
+        return archives
+
+
+histories = {}  # Ключ таблицы -> MonthHistory
+
+
+def history_for(spreadsheet_key):
+    history = histories.get(spreadsheet_key)
+    if history is None:
+        history = histories[spreadsheet_key] = MonthHistory(spreadsheet_key)
+    return history
+
+
+def month_range(start_month, end_month):
+    year, month = map(int, start_month.split("-"))
+    while f"{year:04d}-{month:02d}" <= end_month:
+        yield f"{year:04d}-{month:02d}"
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+async def load_history(ctx, start_month, end_month):
+    # Откуда брать траты каждого месяца: из листа ГГГГ-ММ, если в нём есть траты, иначе из основного листа
+    ledger = await get_ledger(ctx)
+    current_month = (ctx.fake_date or datetime.now(pytz.timezone('Asia/Yerevan')).strftime("%Y-%m-%d"))[:7]
+    history = history_for(ctx.sheet[0])
+    worksheets = await history.list_worksheets()
+    months = [title for title in worksheets if MONTH_SHEET_TITLE.match(title) and start_month <= title <= end_month]
+    archives = await history.load_months(sorted(months), current_month) if months else {}
+
+    sources = {}
+    for month in month_range(start_month, end_month):
+        archive = archives.get(month)
+        sources[month] = archive if archive is not None and archive.month_totals.get(month) else ledger
+    return sources, archives
+
+
+# 🗂 Команда /history — траты по месяцам за период (по умолчанию последние полгода)
+async def get_history(message: Message):
+    try:
+        ctx = contexts.get(message.chat.id)
+        args = message.text.split()[1:]
+        try:
+            if len(args) == 2:
+                start_month, end_month = (datetime.strptime(arg, "%Y-%m").strftime("%Y-%m") for arg in args)
+            elif not args:
+                today = datetime.strptime(ctx.fake_date, "%Y-%m-%d") if ctx.fake_date else datetime.now(pytz.timezone('Asia/Yerevan'))
+                end_month = today.strftime("%Y-%m")
+                start_month = f"{today.year - (today.month <= 5):04d}-{(today.month - 6) % 12 + 1:02d}"
+            else:
+                raise ValueError("нужно два месяца")
+            if start_month > end_month:
+                raise ValueError("начало периода позже конца")
+        except ValueError:
+            await message.answer("Формат: /history [ГГГГ-ММ ГГГГ-ММ]")
+            return
+
+        sources, archives = await load_history(ctx, start_month, end_month)
+        lines = [f"🗂 Траты по месяцам ({start_month} — {end_month}):"]
+        total = 0
+        for month, source in sources.items():
+            spent = source.month_totals.get(month, 0)
+            total += spent
+            line = f"- {month}: {spent:.2f} AMD"
+            archive = archives.get(month)
+            if archive is not None and archive.cell("B17"):
+                line += f" из {archive.cell('B17')}"
+            lines.append(line)
+        lines.append(f"Всего: {total:.2f} AMD")
+        await message.answer("\n".join(lines))
     except Exception as e:
-        logging.error(f"Ошибка при создании нового листа: {e}")
+        logging.error(f"Ошибка при получении истории: {e}")
+        await message.answer("Произошла ошибка при получении истории.")
+
+
+async def create_new_month_sheet(ctx):
+    # Текущая дата или фейковая дата
+    today = datetime.strptime(ctx.fake_date, "%Y-%m-%d") if ctx.fake_date else datetime.now(pytz.timezone('Asia/Yerevan'))
+    await create_month_sheet(ctx.sheet[0], ctx.ledger, today.strftime("%Y-%m"))
+
+
+async def create_month_sheet(spreadsheet_key, ledger, new_sheet_title):
+    history = history_for(spreadsheet_key)
+    # Лист может создавать и ночная задача, и запрос пользователя — не даём им сделать это дважды
+    async with history.create_lock:
+        try:
+            await copy_month_sheet(history, ledger, new_sheet_title)
+        except Exception as e:
+            logging.error(f"Ошибка при создании нового листа: {e}")
+
+
+def header_through_marker(header, sheet_title):
+    # Строки шапки до раздела "Daily expenses" включительно; без раздела — вся шапка
+    for i, row in enumerate(header):
+        if "Daily expenses" in row:
+            return header[:i + 1]
+    logging.warning(f"В шапке листа {sheet_title} нет раздела 'Daily expenses' — берём всю шапку ({len(header)} строк)")
+    return header
+
+
+async def copy_month_sheet(history, ledger, new_sheet_title):
+    # Проверяем, существует ли уже лист на новый месяц (по кэшированному списку листов)
+    worksheets = await history.list_worksheets()
+    if new_sheet_title in worksheets:
+        logging.info(f"Лист {new_sheet_title} уже существует.")
+        return
+
+    # Создаём новый лист
+    new_sheet = await sheets_call(history.spreadsheet.add_worksheet, title=new_sheet_title, rows="100", cols="20", priority=PRIORITY_BACKGROUND)
+    history.worksheets[new_sheet_title] = new_sheet
+
+    # Копируем данные из основного листа до раздела "Daily expenses"
+    source_data = header_through_marker(ledger.header, new_sheet_title)
+
+    # Вставляем скопированные данные в новый лист
+    await sheets_call(new_sheet.update, "A1", source_data, priority=PRIORITY_BACKGROUND)
+    logging.info(f"Создан новый лист: {new_sheet_title} с копией данных до 'Daily expenses'")
+
+
+@profiling.traced("parse.message")
+def parse_expense_rows(records, today, skip_header=False):
+    # Разбор строк «категория, сумма[, дата]» за один проход: (траты, ошибки)
+    rows, errors = [], []
+    for number, record in enumerate(records, start=1):
+        fields = [field.strip() for field in record]
+        if not any(fields):
+            continue
+        if number == 1 and skip_header and len(fields) > 1 and not fields[1].replace(".", "").isdigit():
+            continue  # Заголовок CSV
+        if len(rows) >= IMPORT_MAX_ROWS:
+            errors.append(f"За раз можно записать не больше {IMPORT_MAX_ROWS} трат")
+            break
+        if len(fields) not in (2, 3) or not fields[0]:
+            errors.append(f"Строка {number}: нужен формат «категория, сумма» или «категория, сумма, ГГГГ-ММ-ДД»")
+            continue
+        try:
+            if not fields[1].replace(".", "").isdigit():
+                raise ValueError(fields[1])
+            amount = float(fields[1])  # «1.2.3» проходит проверку цифр, но не float
+        except ValueError:
+            errors.append(f"Строка {number}: сумма должна быть числом")
+            continue
+        date = fields[2] if len(fields) == 3 else today
+        try:
+            datetime.strptime(date, "%Y-%m-%d")
+        except ValueError:
+            errors.append(f"Строка {number}: дата должна быть в формате ГГГГ-ММ-ДД")
+            continue
+        rows.append([fields[0], amount, date])
+    return rows, errors
+
+
+# Ответ, когда строки уже отправлены в таблицу, но она не подтвердила запись за SHEETS_TIMEOUT
+QUEUED_REPLY = "Google Таблица отвечает медленно — запись в очереди и появится в таблице сама, не отправляй её повторно."
+
+
+async def save_expense_rows(message, rows, errors):
+    # Все траты пишутся одним запросом; если хоть одна строка с ошибкой — не пишем ничего
+    if errors:
+        shown = "\n".join(errors[:10])
+        more = f"\n…и ещё {len(errors) - 10}" if len(errors) > 10 else ""
+        await message.answer(f"Ничего не записано, исправь ошибки:\n{shown}{more}")
+        return
+    if not rows:
+        await message.answer("Не нашёл ни одной траты. Формат строки: категория, сумма[, ГГГГ-ММ-ДД]")
+        return
+
+    ctx = contexts.get(message.chat.id)
+    ledger = await get_ledger(ctx)
+    if not await ledger.append_expenses(rows):
+        await message.answer(QUEUED_REPLY)
+        return
+    ctx.cached_budget = recalculate_daily_budget(ctx, await get_daily_budget_limit(ctx))
+
+    total = sum(amount for _, amount, _ in rows)
+    reply = f"Записано трат: {len(rows)} на сумму {total:.2f} AMD"
+    if ctx.cached_budget is not None:
+        reply += f"\nДневной лимит теперь: {ctx.cached_budget:.2f} AMD"
+    await message.answer(reply)
+
+    if CHART_PRERENDER:
+        schedule_chart_prerender(ledger, message.chat.id)
+
+
+# 📥 Траты из CSV-файла: категория, сумма[, дата] — разбираются потоком и пишутся одним запросом
+async def import_expenses_file(message: Message):
+    try:
+        document = message.document
+        if not (document.file_name or "").lower().endswith(".csv") and not (document.mime_type or "").startswith("text/"):
+            await message.answer("Пришли CSV-файл со строками: категория, сумма[, ГГГГ-ММ-ДД]")
+            return
+
+        buffer = await bot.download(document)
+        text = io.TextIOWrapper(buffer, encoding="utf-8-sig", newline="")
+        # Excel в русской локали сохраняет CSV через «;» — разделитель определяем по первой строке
+        first_line = text.readline()
+        text.seek(0)
+        delimiter = max(",;\t", key=first_line.count)
+
+        today = datetime.now(pytz.timezone('Asia/Yerevan')).strftime("%Y-%m-%d")
+        rows, errors = parse_expense_rows(csv.reader(text, delimiter=delimiter), today, skip_header=True)
+        await save_expense_rows(message, rows, errors)
+    except UnicodeDecodeError:
+        await message.answer("Не получилось прочитать файл — сохрани его в кодировке UTF-8.")
+    except asyncio.TimeoutError:
+        await message.answer("Google Таблица сейчас недоступна — ничего не записано, попробуй позже.")
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке трат из файла: {e}")
+        await message.answer("Произошла ошибка при загрузке файла.")
 
 
 @router.message()
 async def add_expense(message: Message):
-    global cached_budget
     try:
+        if "\n" in message.text.strip():
+            # Несколько трат одним сообщением — по одной на строку
+            today = datetime.now(pytz.timezone('Asia/Yerevan')).strftime("%Y-%m-%d")
+            rows, errors = parse_expense_rows(csv.reader(message.text.strip().splitlines()), today)
+            await save_expense_rows(message, rows, errors)
+            return
+
         text = message.text.strip().split(",")
         if len(text) != 2:
             await message.answer("Введи траты в формате: категория, сумма. Например: еда, 1500")
@@ -135,23 +1705,31 @@ async def add_expense(message: Message):
         armenia_tz = pytz.timezone('Asia/Yerevan')
         date_today = datetime.now(armenia_tz).strftime("%Y-%m-%d")
 
-        # Запись в Google Таблицу
-	
-        sheet.append_row([category, amount, date_today], table_range="A20:C")
+        # Запись в Google Таблицу (и в зеркало в памяти)
+        ctx = contexts.get(message.chat.id)
+        ledger = await get_ledger(ctx)
+        if not await ledger.append_expense(category, amount, date_today):
+            await message.answer(QUEUED_REPLY)
+            return
 
         # Сохраняем исходный дневной лимит ДО пересчёта
-        original_budget = cached_budget if cached_budget is not None else get_daily_budget_limit()
+        original_budget = ctx.cached_budget if ctx.cached_budget is not None else await get_daily_budget_limit(ctx)
 
         # Пересчитываем дневной бюджет после новой траты
-        cached_budget = recalculate_daily_budget(get_daily_budget_limit())
+        ctx.cached_budget = recalculate_daily_budget(ctx, await get_daily_budget_limit(ctx))
 
         # Считаем траты за сегодня
-        total_spent = get_today_expenses()
+        total_spent = get_today_expenses(ctx)
 
         # Корректный расчёт процента от ИСХОДНОГО дневного лимита
         percent_spent = (total_spent / original_budget) * 100 if original_budget > 0 else 100
 
         await message.answer(f"Записано: {category} - {amount} AMD\nПотрачено {percent_spent:.2f}% от суммы сегодняшнего лимита")
+
+        if CHART_PRERENDER:
+            schedule_chart_prerender(ledger, message.chat.id)
+    except asyncio.TimeoutError:
+        await message.answer("Google Таблица сейчас недоступна — ничего не записано, попробуй позже.")
     except Exception as e:
         logging.error(f"Ошибка: {e}")
         await message.answer("Произошла ошибка. Проверь формат данных.")
@@ -159,67 +1737,39 @@ async def add_expense(message: Message):
 
 
 
-# Функция для подсчёта оставшихся дней в месяце
-def get_remaining_days():
-    today = datetime.strptime(fake_date, "%Y-%m-%d") if fake_date else datetime.now()  # Используем fake_date
-    last_day = (today.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
-    return (last_day - today).days + 1  # Включаем сегодняшний день
-
-
 # Функция для подсчёта трат за сегодня
-def get_today_expenses():
+def get_today_expenses(ctx):
     try:
         import pytz
         armenia_tz = pytz.timezone('Asia/Yerevan')
-        values = sheet.get_all_values()
-        total_spent = 0
-        today = fake_date if fake_date else datetime.now(armenia_tz).strftime("%Y-%m-%d")
-
-        for row in values:
-            if len(row) >= 3:
-                expense_date = row[2].strip()
-                if expense_date == today:
-                    try:
-                        expense_amount = float(row[1].strip().replace(",", "").replace(" ", ""))
-                        total_spent += expense_amount
-                    except ValueError:
-                        continue
-
-        return total_spent
+        today = ctx.fake_date if ctx.fake_date else datetime.now(armenia_tz).strftime("%Y-%m-%d")
+        return ctx.ledger.day_totals.get(day_ordinal(today), 0)
     except Exception as e:
         logging.error(f"Ошибка при подсчёте трат: {e}")
     return 0
 
 
 
-def recalculate_daily_budget(initial_budget):
+@profiling.traced("budget.recalculate")
+def recalculate_daily_budget(ctx, initial_budget):
 	try:
 		# 🟢 Импортируем pytz для часовых поясов
 		import pytz  
 		armenia_tz = pytz.timezone('Asia/Yerevan')
-		current_date = datetime.now(armenia_tz) if not fake_date else datetime.strptime(fake_date, "%Y-%m-%d")
+		current_date = datetime.now(armenia_tz) if not ctx.fake_date else datetime.strptime(ctx.fake_date, "%Y-%m-%d")
 
-		# 🟢 Считаем оставшиеся дни без +1 дня
-		last_day_of_month = armenia_tz.localize(datetime(current_date.year, current_date.month, 31))
-		# 🟢 Добавляем +1 день, если текущий день ещё не закончился
-		remaining_days = max((last_day_of_month - current_date).days + 1, 0)
+		# 🟢 Оставшиеся дни по настоящей длине месяца, включая сегодняшний — он ещё не закончился
+		days_in_month = calendar.monthrange(current_date.year, current_date.month)[1]
+		remaining_days = max(days_in_month - current_date.day + 1, 0)
 
 		# 🟢 Фиксируем общий месячный бюджет из ячейки B17
-		fixed_monthly_budget = get_monthly_budget()
-
-		# 🟢 Получаем все траты за текущий месяц
-		values = sheet.get_all_values()
-		total_budget_spent = 0
-		for row in values:
-			if len(row) >= 3:
-				try:
-					expense_date = row[2].strip()
-					expense_amount = float(row[1].strip().replace(",", "").replace(" ", ""))
-					# 🟢 Учитываем только траты за текущий месяц на основе фейковой даты
-					if expense_date[:7] == current_date.strftime("%Y-%m"):
-						total_budget_spent += expense_amount
-				except ValueError:
-					continue
+		fixed_monthly_budget = get_monthly_budget(ctx)
+		if fixed_monthly_budget is None:
+			logging.error("Месячный бюджет недоступен, оставляем дневной лимит без перерасчёта")
+			return initial_budget
+
+		# 🟢 Траты за текущий месяц (с учётом фейковой даты) — из накопительных сумм
+		total_budget_spent = ctx.ledger.month_totals.get(current_date.strftime("%Y-%m"), 0)
 
 		# 🟢 Оставшийся бюджет за месяц
 		remaining_budget = fixed_monthly_budget - total_budget_spent
@@ -259,34 +1809,34 @@ def recalculate_daily_budget(initial_budget):
 
 
 
-def get_daily_budget_limit():
-    global cached_budget, last_budget_update
+async def get_daily_budget_limit(ctx):
     try:
-        current_date = fake_date if fake_date else datetime.now().strftime("%Y-%m-%d")
-        current_month = fake_date[:7] if fake_date else datetime.now().strftime("%Y-%m")
+        armenia_tz = pytz.timezone('Asia/Yerevan')
+        current_date = ctx.fake_date if ctx.fake_date else datetime.now(armenia_tz).strftime("%Y-%m-%d")
+        current_month = current_date[:7]
 
-        # Проверяем смену месяца и создаём новый лист при необходимости
-        if last_budget_update and last_budget_update[:7] != current_month:
-            create_new_month_sheet()
+        # Лист на новый месяц обычно уже создала ночная задача; если бот в полночь не работал — создаём в фоне
+        if ctx.last_budget_update and ctx.last_budget_update[:7] != current_month:
+            asyncio.create_task(create_new_month_sheet(ctx))
 
         # Если лимит уже загружен сегодня, используем кэш
-        if cached_budget is not None and last_budget_update == current_date:
-            return cached_budget  
+        if ctx.cached_budget is not None and ctx.last_budget_update == current_date:
+            budget_cache_lookups.inc("hit")
+            return ctx.cached_budget
+        budget_cache_lookups.inc("miss")
 
-        # Запрашиваем данные из Google Sheets
-        values = sheet.get_all_values()
-        for row in values:
-            if row[0] == "Daily budget limit, AMD":
-                raw_value = row[1].strip().replace(" ", "").replace(",", ".")
-                budget = float(raw_value)
+        # Берём лимит из зеркала таблицы
+        raw_value = ctx.ledger.setting("Daily budget limit, AMD")
+        if raw_value is not None:
+            budget = float(raw_value.strip().replace(" ", "").replace(",", "."))
 
-                # Пересчитываем бюджет только если меняется день
-                new_budget = recalculate_daily_budget(budget) if last_budget_update != current_date else budget
-                cached_budget = new_budget
-                last_budget_update = current_date
+            # Пересчитываем бюджет только если меняется день
+            new_budget = recalculate_daily_budget(ctx, budget) if ctx.last_budget_update != current_date else budget
+            ctx.cached_budget = new_budget
+            ctx.last_budget_update = current_date
 
-                logging.info(f"Обновлённый дневной лимит: {cached_budget}")
-                return cached_budget
+            logging.info(f"Обновлённый дневной лимит (чат {ctx.chat_id}): {ctx.cached_budget}")
+            return ctx.cached_budget
 
     except Exception as e:
         logging.error(f"Ошибка при получении бюджета: {e}")
@@ -295,25 +1845,24 @@ def get_daily_budget_limit():
 
 @router.message(Command("budget_default"))
 async def reset_budget(message: Message):
-    global cached_budget, last_budget_update
     try:
         # Сбрасываем кэшированный дневной лимит
-        cached_budget = None
-        last_budget_update = None
-
-        # Получаем новое значение из Google Sheets БЕЗ перерасчёта!
-        values = sheet.get_all_values()
-        for row in values:
-            if row[0] == "Daily budget limit, AMD":
-                raw_value = row[1].strip().replace(" ", "").replace(",", ".")
-                cached_budget = float(raw_value)  # Просто берём исходный лимит
-                last_budget_update = datetime.now()
-                break  # Выходим из цикла, чтобы не делать лишние запросы
-        
-        if cached_budget is None:
+        ctx = contexts.get(message.chat.id)
+        ctx.cached_budget = None
+        ctx.last_budget_update = None
+
+        # Перечитываем таблицу и берём новое значение БЕЗ перерасчёта!
+        ledger = await get_ledger(ctx)
+        await ledger.load()
+        raw_value = ledger.setting("Daily budget limit, AMD")
+        if raw_value is not None:
+            ctx.cached_budget = float(raw_value.strip().replace(" ", "").replace(",", "."))  # Просто берём исходный лимит
+            ctx.last_budget_update = ctx.fake_date if ctx.fake_date else datetime.now(pytz.timezone('Asia/Yerevan')).strftime("%Y-%m-%d")
+
+        if ctx.cached_budget is None:
             await message.answer("Не удалось сбросить бюджет. Проверь настройки.")
         else:
-            await message.answer(f"Бюджет сброшен!\nНовый дневной лимит: {cached_budget:.2f} AMD")
+            await message.answer(f"Бюджет сброшен!\nНовый дневной лимит: {ctx.cached_budget:.2f} AMD")
 
     except Exception as e:
         logging.error(f"Ошибка при сбросе бюджета: {e}")
@@ -323,7 +1872,9 @@ async def reset_budget(message: Message):
 @router.message(Command("budget_now"))
 async def get_current_budget(message: Message):
     try:
-        daily_budget = get_daily_budget_limit()
+        ctx = contexts.get(message.chat.id)
+        await get_ledger(ctx)
+        daily_budget = await get_daily_budget_limit(ctx)
         if daily_budget is None:
             await message.answer("Не удалось получить текущий дневной лимит.")
         else:
@@ -339,11 +1890,14 @@ async def get_budget_left(message: Message):
         import pytz
         armenia_tz = pytz.timezone('Asia/Yerevan')
         
+        ctx = contexts.get(message.chat.id)
+
         # 🟢 Используем дату с учётом часового пояса
-        today = fake_date if fake_date else datetime.now(armenia_tz).strftime("%Y-%m-%d")
-        
-        daily_budget = get_daily_budget_limit()
-        total_spent_today = get_today_expenses()
+        today = ctx.fake_date if ctx.fake_date else datetime.now(armenia_tz).strftime("%Y-%m-%d")
+
+        await get_ledger(ctx)
+        daily_budget = await get_daily_budget_limit(ctx)
+        total_spent_today = get_today_expenses(ctx)
 
         budget_left = max(daily_budget - total_spent_today, 0)
 
@@ -353,10 +1907,44 @@ async def get_budget_left(message: Message):
         await message.answer("Произошла ошибка при получении оставшегося бюджета.")
 
 
+@router.message(Command("resync"))
+async def resync_ledger(message: Message):
+    try:
+        # Перечитываем таблицу, если её правили вручную
+        ctx = contexts.get(message.chat.id)
+        ledger = await get_ledger(ctx)
+        await ledger.load()
+        ctx.cached_budget = None
+        ctx.last_budget_update = None
+        await message.answer(f"Таблица перечитана: {len(ledger.expenses)} строк с тратами.")
+    except Exception as e:
+        logging.error(f"Ошибка при ресинхронизации таблицы: {e}")
+        await message.answer("Произошла ошибка при чтении таблицы.")
+
+
+@router.message(Command("sheets_status"))
+async def get_sheets_status(message: Message):
+    try:
+        # Состояние очереди запросов к Google Sheets
+        names = {PRIORITY_INTERACTIVE: "срочные", PRIORITY_NORMAL: "обычные", PRIORITY_BACKGROUND: "фоновые"}
+        lines = ["📡 Запросы к Google Sheets:"]
+        for (kind, priority), depth in sorted(sheets_scheduler.depth.items()):
+            if depth:
+                lines.append(f"- в очереди ({'запись' if kind == 'write' else 'чтение'}, {names[priority]}): {depth}")
+        lines.append(f"Выполняется: {sheets_scheduler.in_flight}")
+        lines.append(f"Всего вызовов: {sheets_scheduler.calls}, повторов: {sheets_scheduler.retries}, ошибок: {sheets_scheduler.errors}")
+        lines.append(f"Чтений без обращения к API (общий результат): {sheets_reads.shared}")
+        lines.append(f"Упёрлись в квоту (429): {sheets_scheduler.throttle_events}")
+        await message.answer("\n".join(lines))
+    except Exception as e:
+        logging.error(f"Ошибка при получении состояния Sheets: {e}")
+        await message.answer("Произошла ошибка при получении состояния Sheets.")
+
+
 @router.message(Command("set_date"))
 async def set_fake_date(message: Message):
-    global fake_date, cached_budget, last_budget_update
     try:
+        ctx = contexts.get(message.chat.id)
         parts = message.text.strip().split()
         if len(parts) != 2:
             await message.answer("Используй формат: /set_date YYYY-MM-DD или /set_date reset")
@@ -365,25 +1953,26 @@ async def set_fake_date(message: Message):
         new_date = parts[1]
 
         if new_date.lower() == "reset":  # Возвращаем реальную дату
-            fake_date = None
-            cached_budget = None
-            last_budget_update = None
+            ctx.fake_date = None
+            ctx.cached_budget = None
+            ctx.last_budget_update = None
             await message.answer("Дата сброшена! Бот снова использует реальное время.")
             return
 
         # Проверяем формат даты
         datetime.strptime(new_date, "%Y-%m-%d")
-        fake_date = new_date  # Устанавливаем фейковую дату
+        ctx.fake_date = new_date  # Устанавливаем фейковую дату
 
         # Сбрасываем кэш и пересчитываем лимит
-        cached_budget = None
-        last_budget_update = None
+        ctx.cached_budget = None
+        ctx.last_budget_update = None
 
         # Пересчитываем дневной лимит на основе фейковой даты
-        new_budget = get_daily_budget_limit()
+        await get_ledger(ctx)
+        new_budget = await get_daily_budget_limit(ctx)
 
         if new_budget is not None:
-            await message.answer(f"Дата изменена! Теперь бот считает, что сегодня: {fake_date}\nНовый дневной лимит: {new_budget:.2f} AMD")
+            await message.answer(f"Дата изменена! Теперь бот считает, что сегодня: {ctx.fake_date}\nНовый дневной лимит: {new_budget:.2f} AMD")
         else:
             await message.answer("Не удалось пересчитать бюджет для новой даты.")
 
@@ -394,67 +1983,235 @@ async def set_fake_date(message: Message):
         await message.answer("Произошла ошибка при смене даты.")
 
 
-def get_monthly_budget():
+def get_monthly_budget(ctx):
     try:
         # Получаем значение из ячейки B17 ("Balance, AMD")
-        value = sheet.acell("B17").value
+        value = ctx.ledger.cell("B17")
         return float(value.strip().replace(",", "").replace(" ", ""))
     except Exception as e:
         logging.error(f"Ошибка при получении месячного бюджета: {e}")
-        return 0  # Если ошибка, возвращаем 0
+        return None  # Не подменяем бюджет нулём — иначе дневной лимит молча обнулится
+
+@profiling.traced("aggregate.range")
+async def range_stats(ctx, start, end):
+    # Траты за период из префиксных сумм: (итог, {категория: сумма}, {дата: сумма за день})
+    ledger = await get_ledger(ctx)
+    try:
+        sources, _ = await load_history(ctx, start[:7], end[:7])
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке истории, считаем только по основному листу: {e}")
+        sources = {month: ledger for month in month_range(start[:7], end[:7])}
+
+    # Подряд идущие месяцы из одного источника считаем одним запросом к индексу
+    spans = []
+    for month, source in sources.items():
+        month_start = date_type.fromisoformat(f"{month}-01")
+        month_end = (month_start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+        first_day = max(day_ordinal(start), month_start.toordinal())
+        last_day = min(day_ordinal(end), month_end.toordinal())
+        if spans and spans[-1][0] is source:
+            spans[-1][2] = last_day
+        else:
+            spans.append([source, first_day, last_day])
+
+    total, category_totals, day_totals = 0, {}, {}
+    for source, first_day, last_day in spans:
+        total += source.day_index.sum(first_day, last_day)
+        for category, index in source.category_index.items():
+            spent = index.sum(first_day, last_day)
+            if spent:
+                category_totals[category] = category_totals.get(category, 0) + spent
+        for day, spent in source.day_index.daily(first_day, last_day):
+            day_totals[date_type.fromordinal(day)] = spent
+    return total, category_totals, day_totals
+
+
+# Текст статистики по категориям — для /stats и регулярных отчётов
+def format_stats(category_totals, total_spent, title, empty):
+    if not category_totals:
+        return empty
+    stats_message = title
+    for category, total in sorted(category_totals.items(), key=lambda x: x[1], reverse=True):
+        stats_message += f"- {category}: {total:.2f} AMD\n"
+    stats_message += f"Всего: {total_spent:.2f} AMD"
+    return stats_message
+
 
 @router.message(Command("stats"))
 async def get_monthly_stats(message: Message):
     try:
         # Используем фейковую дату, если она установлена
-        current_date = datetime.strptime(fake_date, "%Y-%m-%d") if fake_date else datetime.now()
+        ctx = contexts.get(message.chat.id)
+        current_date = datetime.strptime(ctx.fake_date, "%Y-%m-%d") if ctx.fake_date else datetime.now()
         current_month = current_date.strftime("%Y-%m")
 
-        # Получаем данные из Google Sheets начиная с A21
-        values = sheet.get("A21:C1000")  # Смотрим до тысячи строк на всякий случай
-
-        # Считаем траты по категориям
-        category_totals = {}
-        total_spent = 0
-
-        for row in values:
-            # Пропускаем пустые строки
-            if len(row) < 3 or not row[1].strip().replace(",", "").replace(" ", "").isdigit():
-                continue
-
+        args = (message.text or "").split()[1:]
+        if args:
+            # Произвольный период: /stats 2025-01-15 2025-03-10, /stats 2025-02, /stats 30d
             try:
-                category = row[0].strip()
-                amount = float(row[1].strip().replace(",", "").replace(" ", ""))
-                date = row[2].strip()
-
-                # Учитываем только траты за текущий месяц
-                if date.startswith(current_month):
-                    if category in category_totals:
-                        category_totals[category] += amount
-                    else:
-                        category_totals[category] = amount
-                    total_spent += amount
+                start, end = parse_period(ctx, args)
             except ValueError:
-                continue
-
-        # Формируем сообщение со статистикой
-        if category_totals:
-            stats_message = "📊 Статистика за месяц:\n"
-            for category, total in sorted(category_totals.items(), key=lambda x: x[1], reverse=True):
-                stats_message += f"- {category}: {total:.2f} AMD\n"
-            stats_message += f"Всего: {total_spent:.2f} AMD"
+                await message.answer("Формат: /stats [ГГГГ-ММ | ГГГГ-ММ-ДД ГГГГ-ММ-ДД | 30d]")
+                return
+            total_spent, category_totals, _ = await range_stats(ctx, start, end)
+            title, empty = f"📊 Статистика за {start} — {end}:\n", "📊 За этот период нет трат."
         else:
-            stats_message = "📊 За этот месяц пока нет трат."
+            # Траты по категориям за текущий месяц — из накопительных сумм
+            ledger = await get_ledger(ctx)
+            category_totals = ledger.month_category_totals.get(current_month, {})
+            total_spent = ledger.month_totals.get(current_month, 0)
+            title, empty = "📊 Статистика за месяц:\n", "📊 За этот месяц пока нет трат."
 
-        await message.answer(stats_message)
+        await message.answer(format_stats(category_totals, total_spent, title, empty))
     except Exception as e:
         logging.error(f"Ошибка при получении статистики: {e}")
         await message.answer("Произошла ошибка при получении статистики.")
 
 
+# 📈 Команда /forecast [сумма в день] — прогноз остатка на конец месяца по темпу трат
+async def get_forecast(message: Message):
+    try:
+        # NumPy нужен только для прогноза и графиков — импортируем при первом вызове
+        import numpy as np
+        import budget
+
+        ctx = contexts.get(message.chat.id)
+        args = message.text.split()[1:]
+        try:
+            what_if = float(args[0].replace(",", ".")) if args else None
+        except ValueError:
+            await message.answer("Формат: /forecast [сумма в день]")
+            return
+
+        ledger = await get_ledger(ctx)
+        monthly_budget = get_monthly_budget(ctx)
+        if monthly_budget is None:
+            await message.answer("Не удалось получить месячный бюджет из таблицы.")
+            return
+
+        today = datetime.strptime(ctx.fake_date, "%Y-%m-%d").date() if ctx.fake_date else datetime.now(pytz.timezone('Asia/Yerevan')).date()
+        month_start = today.replace(day=1)
+        month_length = calendar.monthrange(today.year, today.month)[1]
+
+        # Траты по дням месяца до сегодня включительно — из индекса префиксных сумм
+        amounts = np.zeros(today.day)
+        for day, spent in ledger.day_index.daily(month_start.toordinal(), today.toordinal()):
+            amounts[day - month_start.toordinal()] = spent
+
+        # Все сценарии считаются одним пакетом: средний темп месяца, темп последней недели и «что если»
+        window = 7
+        recent = amounts[-window:].mean()
+        scenarios = [("при среднем темпе месяца", amounts.mean()), (f"при темпе последних {min(window, today.day)} дн.", recent)]
+        if what_if is not None:
+            scenarios.append(("при заданном темпе", what_if))
+        result = budget.forecast_month(
+            np.tile(amounts, (len(scenarios), 1)), monthly_budget, month_length,
+            daily_spend=[pace for _, pace in scenarios], window=window,
+        )
+
+        lines = [
+            f"📈 Прогноз на конец месяца ({today.strftime('%Y-%m')}):",
+            f"Бюджет: {monthly_budget:.2f} AMD, потрачено: {result['spent'][0]:.2f} AMD за {today.day} дн. из {month_length}",
+        ]
+        for (label, pace), balance in zip(scenarios, result["projected_balance"]):
+            lines.append(f"- {label} ({pace:.2f} AMD/день): останется {balance:.2f} AMD")
+        lines.append(f"Чтобы уложиться, можно тратить до {result['allowed_daily'][0]:.2f} AMD в день")
+        await message.answer("\n".join(lines))
+    except Exception as e:
+        logging.error(f"Ошибка при расчёте прогноза: {e}")
+        await message.answer("Произошла ошибка при расчёте прогноза.")
+
+
+# 📤 Выгрузка трат в CSV: строки читаются из зеркала и уходят в Telegram кусками, файл целиком не собирается
+def parse_period(ctx, args):
+    # Период: без аргументов — текущий месяц, "ГГГГ-ММ" — месяц, "ГГГГ-ММ-ДД ГГГГ-ММ-ДД" — диапазон, "30d" — последние 30 дней
+    today = ctx.fake_date or datetime.now(pytz.timezone('Asia/Yerevan')).strftime("%Y-%m-%d")
+    if not args:
+        args = [today[:7]]
+    last_days = re.fullmatch(r"(\d+)[dд]", args[0]) if len(args) == 1 else None
+    if last_days:
+        end = datetime.strptime(today, "%Y-%m-%d")
+        start = end - timedelta(days=max(int(last_days.group(1)), 1) - 1)
+        return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+    if len(args) == 1:
+        month_start = datetime.strptime(args[0], "%Y-%m")
+        month_end = (month_start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+        return month_start.strftime("%Y-%m-%d"), month_end.strftime("%Y-%m-%d")
+    if len(args) == 2:
+        start, end = (datetime.strptime(arg, "%Y-%m-%d").strftime("%Y-%m-%d") for arg in args)
+        if start > end:
+            raise ValueError("начало периода позже конца")
+        return start, end
+    raise ValueError("слишком много аргументов")
+
+
+class LedgerCsvFile(InputFile):
+    def __init__(self, ledger, start, end, compress=False, filename=None):
+        super().__init__(filename=filename, chunk_size=EXPORT_CHUNK_SIZE)
+        self.ledger = ledger
+        self.start = start
+        self.end = end
+        self.compress = compress
+
+    async def read(self, bot):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if self.compress else None  # | 16 — формат gzip
+        writer.writerow(["category", "amount", "date"])
+
+        def take_chunk():
+            chunk = buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            return compressor.compress(chunk) if compressor else chunk
+
+        # Фильтр по колонке номеров дней — сравнение целых чисел. Берём колонки на момент начала выгрузки:
+        # дописанные за это время траты не мешают, а перезагрузка листа подменяет колонки целиком
+        expenses = self.ledger.expenses
+        first_day, last_day = day_ordinal(self.start), day_ordinal(self.end)
+        for index in range(len(expenses)):
+            day = expenses.days[index]
+            if not first_day <= day <= last_day:
+                continue
+            category = expenses.categories[expenses.category_ids[index]]
+            writer.writerow([category, format_amount(expenses.amounts[index]), date_type.fromordinal(day).isoformat()])
+            if buffer.tell() >= self.chunk_size:
+                chunk = take_chunk()
+                if chunk:
+                    yield chunk
+                await asyncio.sleep(0)  # Не держим цикл событий на больших выгрузках
+
+        chunk = take_chunk()
+        if compressor:
+            chunk += compressor.flush()
+        if chunk:
+            yield chunk
+
+
+async def export_expenses(message: Message):
+    try:
+        args = message.text.split()[1:]
+        compress = "gz" in args
+        args = [arg for arg in args if arg != "gz"]
+        ctx = contexts.get(message.chat.id)
+        try:
+            start, end = parse_period(ctx, args)
+        except ValueError:
+            await message.answer("Формат: /export [ГГГГ-ММ | ГГГГ-ММ-ДД ГГГГ-ММ-ДД | 30d] [gz]")
+            return
+
+        ledger = await get_ledger(ctx)
+        filename = f"expenses_{start}_{end}.csv" + (".gz" if compress else "")
+        await bot.send_document(message.chat.id, LedgerCsvFile(ledger, start, end, compress, filename=filename))
+    except Exception as e:
+        logging.error(f"Ошибка при выгрузке трат: {e}")
+        await message.answer("Произошла ошибка при выгрузке трат.")
+
+
 import pytz
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
 from aiogram.types import Message
 
 # 🟢 Устанавливаем часовой пояс для Еревана через pytz
@@ -463,139 +2220,357 @@ timezone = pytz.timezone('Asia/Yerevan')
 # 🟢 Создаём планировщик задач с использованием pytz
 scheduler = AsyncIOScheduler(timezone=timezone)
 
-# 🔄 Укажите здесь ваш реальный chat_id
-YOUR_CHAT_ID = 151719897  # Ваш реальный chat_id
+# 🔄 Регулярные отчёты: подписка командами /subscribe и /unsubscribe, список хранится в файле.
+# Пока файла нет, подписан только REPORT_CHAT_ID; если и он не задан — отчёты уходят только подписавшимся через /subscribe
+YOUR_CHAT_ID = int(os.getenv("REPORT_CHAT_ID")) if os.getenv("REPORT_CHAT_ID") else None
+REPORT_SUBSCRIBERS_FILE = os.getenv("REPORT_SUBSCRIBERS_FILE", "subscribers.json")
+REPORT_CONCURRENCY = int(os.getenv("REPORT_CONCURRENCY", "20"))  # Сколько отчётов отправляется одновременно
+REPORT_MESSAGES_PER_SECOND = float(os.getenv("REPORT_MESSAGES_PER_SECOND", "25"))  # Общий лимит Telegram — около 30 в секунду
+REPORT_CHAT_INTERVAL = float(os.getenv("REPORT_CHAT_INTERVAL", "1"))  # Пауза между сообщениями в один чат, в секундах
+REPORT_MAX_RETRIES = int(os.getenv("REPORT_MAX_RETRIES", "3"))  # Повторы после flood-wait и сетевых ошибок
+
+reports_sent = metrics.Counter("cashtrack_reports_sent", "Отправка регулярных отчётов по чатам", ("report", "outcome"))
 
-# 🟢 Функция для отправки статистики автоматически
-async def send_weekly_stats():
+
+def load_subscribers():
+    default = {YOUR_CHAT_ID} if YOUR_CHAT_ID is not None else set()
+    try:
+        with open(REPORT_SUBSCRIBERS_FILE, encoding="utf-8") as f:
+            return set(json.load(f))
+    except FileNotFoundError:
+        if not default:
+            logging.warning("REPORT_CHAT_ID не задан и подписчиков нет — регулярные отчёты не отправляются до первой /subscribe")
+        return default
+    except (OSError, ValueError) as e:
+        logging.error(f"Ошибка при чтении списка подписчиков: {e}")
+        return default
+
+
+def save_subscribers():
+    try:
+        with open(REPORT_SUBSCRIBERS_FILE + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(sorted(report_subscribers), f)
+        os.replace(REPORT_SUBSCRIBERS_FILE + ".tmp", REPORT_SUBSCRIBERS_FILE)
+    except OSError as e:
+        logging.error(f"Ошибка при записи списка подписчиков: {e}")
+
+
+report_subscribers = load_subscribers()
+
+
+async def subscribe_reports(message: Message):
+    report_subscribers.add(message.chat.id)
+    save_subscribers()
+    await message.answer("📬 Отчёты включены: статистика за неделю по понедельникам и итоги месяца с графиком 1-го числа.")
+
+
+async def unsubscribe_reports(message: Message):
+    report_subscribers.discard(message.chat.id)
+    save_subscribers()
+    await message.answer("📭 Отчёты выключены.")
+
+
+# Готовый отчёт для всех чатов одного листа: считается один раз, график после первой отправки идёт по file_id
+class Report:
+    def __init__(self, text, chart=None):
+        self.text = text
+        self.chart = chart  # PNG или None
+        self.photo_id = None
+        self.upload_lock = asyncio.Lock()  # График загружается в Telegram один раз, остальные чаты ждут его file_id
+
+
+# Отправка с лимитами Telegram: общее ведро на бота, пауза между сообщениями в один чат и общая пауза после flood-wait
+class ReportSender:
+    def __init__(self):
+        self.bucket = TokenBucket(REPORT_MESSAGES_PER_SECOND * 60, capacity=1)  # Без всплесков — ровный темп
+        self.paused_until = 0
+        self.chat_ready = {}  # chat_id -> когда в этот чат можно писать снова
+
+    async def wait_slot(self, chat_id):
+        while True:
+            now = time.monotonic()
+            delay = max(self.bucket.wait_time(), self.paused_until - now, self.chat_ready.get(chat_id, 0) - now)
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        self.bucket.take()
+        self.chat_ready[chat_id] = time.monotonic() + REPORT_CHAT_INTERVAL
+
+    async def send(self, method, chat_id, **kwargs):
+        # method — bot.send_message или bot.send_photo
+        attempt = 0
+        while True:
+            await self.wait_slot(chat_id)
+            try:
+                return await method(chat_id=chat_id, **kwargs)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > REPORT_MAX_RETRIES:
+                    raise
+                # Flood-wait относится ко всему боту — останавливаем все отправки, а не только этот чат
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                logging.warning(f"Flood-wait от Telegram: пауза {e.retry_after} с (чат {chat_id}, попытка {attempt})")
+            except TelegramNetworkError as e:
+                attempt += 1
+                if attempt > REPORT_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(min(2 ** attempt, 30))
+
+    async def deliver(self, chat_id, report):
+        await self.send(bot.send_message, chat_id, text=report.text)
+        if report.chart is None:
+            return
+        caption = "📊 График расходов за месяц"
+        if report.photo_id is None:
+            async with report.upload_lock:
+                if report.photo_id is None:
+                    photo = BufferedInputFile(report.chart, filename="expense_chart.png")
+                    sent = await self.send(bot.send_photo, chat_id, photo=photo, caption=caption)
+                    if getattr(sent, "photo", None):
+                        report.photo_id = sent.photo[-1].file_id
+                    return
+        await self.send(bot.send_photo, chat_id, photo=report.photo_id, caption=caption)
+
+
+async def build_report(ctx, kind):
+    # weekly — траты за последние 7 дней; monthly — итоги прошедшего месяца с графиком
+    today = datetime.now(timezone).date()
+    if kind == "weekly":
+        start, end = (today - timedelta(days=6)).isoformat(), today.isoformat()
+        total_spent, category_totals, _ = await range_stats(ctx, start, end)
+        text = format_stats(category_totals, total_spent, f"📊 Траты за неделю ({start} — {end}):\n", "📊 За неделю трат не было.")
+        return Report(text)
+
+    last_month_end = today.replace(day=1) - timedelta(days=1)
+    start, end = last_month_end.replace(day=1).isoformat(), last_month_end.isoformat()
+    total_spent, category_totals, date_totals = await range_stats(ctx, start, end)
+    text = format_stats(category_totals, total_spent, f"📊 Итоги за {start[:7]}:\n", f"📊 За {start[:7]} трат не было.")
+    chart = await get_expense_chart(ctx.ledger, period=(start, end), date_totals=date_totals) if date_totals else None
+    return Report(text, chart)
+
+
+async def deliver_reports(sender, queue, kind, outcomes):
+    while not queue.empty():
+        chat_id, report = queue.get_nowait()
+        try:
+            await sender.deliver(chat_id, report)
+            outcome = "sent"
+        except TelegramForbiddenError:
+            # Бота заблокировали или удалили из чата — больше туда не пишем
+            report_subscribers.discard(chat_id)
+            outcome = "blocked"
+        except Exception as e:
+            logging.error(f"Ошибка при отправке отчёта в чат {chat_id}: {e}")
+            outcome = "error"
+        outcomes[outcome] += 1
+        reports_sent.inc(kind, outcome)
+
+
+# 🟢 Рассылка отчёта всем подписчикам: отчёт считается один раз на лист, отправка — REPORT_CONCURRENCY
+# параллельными задачами в пределах лимитов Telegram
+async def send_reports(kind):
+    started = time.perf_counter()
+    chats_by_sheet = {}
+    for chat_id in sorted(report_subscribers):
+        chats_by_sheet.setdefault(sheet_for_chat(chat_id), []).append(chat_id)
+
+    queue = asyncio.Queue()
+    for chat_ids in chats_by_sheet.values():
+        try:
+            ctx = contexts.get(chat_ids[0])
+            await get_ledger(ctx)
+            report = await build_report(ctx, kind)
+        except Exception as e:
+            logging.error(f"Ошибка при подготовке отчёта для {len(chat_ids)} чатов: {e}")
+            reports_sent.inc(kind, "error", amount=len(chat_ids))
+            continue
+        for chat_id in chat_ids:
+            queue.put_nowait((chat_id, report))
+
+    sender = ReportSender()
+    outcomes = Counter()
+    workers = min(REPORT_CONCURRENCY, queue.qsize())
+    await asyncio.gather(*(deliver_reports(sender, queue, kind, outcomes) for _ in range(workers)))
+    if outcomes["blocked"]:
+        save_subscribers()
+    logging.info(
+        f"Отчёт {kind}: листов {len(chats_by_sheet)}, отправлено {outcomes['sent']}, заблокировали бота {outcomes['blocked']}, "
+        f"ошибок {outcomes['error']} за {time.perf_counter() - started:.1f} с"
+    )
+
+
+# 🟢 Статистика за неделю — каждый понедельник в 14:00, итоги месяца — 1-го числа в 10:00
+scheduler.add_job(send_reports, CronTrigger(day_of_week='mon', hour=14, minute=0), args=["weekly"], name="weekly_report")
+scheduler.add_job(send_reports, CronTrigger(day=1, hour=10, minute=0), args=["monthly"], name="monthly_report")
+
+
+# 🌙 Сразу после полуночи по Еревану готовим новый день: лист на новый месяц и дневные лимиты всех чатов,
+# чтобы первая команда дня не ждала ни копирования листа, ни перерасчёта
+async def precompute_new_day():
+    if not sheets_connected.is_set():
+        logging.warning("Таблица ещё не подключена — ночной перерасчёт пропущен")
+        return
+    current_month = datetime.now(timezone).strftime("%Y-%m")
+
+    for key in {DEFAULT_SHEET} | contexts.sheets_in_use():
+        ledger = ledgers.get(key)
+        if ledger is not None and ledger.ready.is_set():
+            await create_month_sheet(key[0], ledger, current_month)
+
+    recalculated = 0
+    for ctx in contexts.all():
+        # Чаты с фейковой датой живут в своём времени — их не трогаем
+        if ctx.fake_date or ctx.ledger is None:
+            continue
+        await get_daily_budget_limit(ctx)
+        recalculated += 1
+        await asyncio.sleep(0)  # Не держим цикл событий на большом числе чатов
+    logging.info(f"Ночной перерасчёт: дневные лимиты обновлены для {recalculated} чатов")
+
+
+scheduler.add_job(precompute_new_day, CronTrigger(hour=0, minute=0, second=30), misfire_grace_time=3600, coalesce=True)
+
+
+def count_scheduler_job(event):
+    job = scheduler.get_job(event.job_id)
+    name = job.name if job else event.job_id
+    outcome = "missed" if event.code == EVENT_JOB_MISSED else "error" if event.exception else "ok"
+    scheduler_job_runs.inc(name, outcome)
+
+
+scheduler.add_listener(count_scheduler_job, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+
+
+
+
+# 📊 Готовим данные для графика из зеркала и рисуем его в пуле процессов
+@profiling.traced("render.chart")
+async def generate_expense_chart(ledger, date_totals=None, today=None):
     try:
-        # Используем фиктивное сообщение для вызова get_monthly_stats
-        message = Message(chat={'id': YOUR_CHAT_ID})
-        await get_monthly_stats(message)
+        armenia_tz = pytz.timezone('Asia/Yerevan')
+
+        # 🟢 Получаем значения бюджета из ячеек B17 и B18
+        total_budget = float(ledger.cell("B17").strip().replace(",", "").replace(" ", ""))
+        first_day_budget = float(ledger.cell("B18").strip().replace(",", ".").replace(" ", ""))
+
+        # 🟢 Суммы по дням уже посчитаны в зеркале — остаётся только перевести номера дней в даты
+        if date_totals is None:
+            date_totals = {date_type.fromordinal(day): total for day, total in ledger.day_totals.items()}
+
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        future = loop.run_in_executor(
+            chart_executor, charts.render_expense_chart,
+            date_totals, total_budget, first_day_budget, today or datetime.now(armenia_tz).date(),
+        )
+        try:
+            image_bytes = await asyncio.wait_for(future, CHART_TIMEOUT)
+        except asyncio.TimeoutError:
+            recycle_chart_pool()
+            raise
+        chart_render_seconds.observe(value=time.perf_counter() - started)
+        return image_bytes
+    except asyncio.TimeoutError:
+        logging.error(f"График не нарисован за {CHART_TIMEOUT:g} с")
+        return None
     except Exception as e:
-        logging.error(f"Ошибка при отправке статистики: {e}")
+        logging.error(f"Ошибка при генерации графика: {e}")
+        return None
 
-# 🟢 Планируем выполнение задачи каждый понедельник в 14:00
-scheduler.add_job(send_weekly_stats, CronTrigger(day_of_week='mon', hour=14, minute=0))
 
 
 
+def start_chart_pool():
+    # Первый запуск forkserver и процессов пула занимает секунды — делаем это в потоке при старте, а не на первом /chart
+    chart_executor.submit(charts.warm_up).result()
+
+
+def recycle_chart_pool():
+    # Таймаут не останавливает процесс пула — он дорисовывает график, занимая место в пуле.
+    # Новые графики отправляем в свежий пул, а старый закроется сам, когда его процессы закончат
+    global chart_executor
+    stuck, chart_executor = chart_executor, make_chart_pool()
+    stuck.shutdown(wait=False)
+
+
+# 🟢 Кэш готовых графиков: (лист, номер зеркала, версия зеркала, дата, чат, период) -> PNG, вытесняются самые давно использованные.
+# Номер зеркала нужен, потому что после выгрузки и повторного открытия листа версии начинаются заново
+chart_cache = OrderedDict()
+chart_renders = {}  # Графики, которые рисуются прямо сейчас, — чтобы не рисовать один и тот же дважды
+chart_prerenders = {}  # chat_id -> запланированная фоновая перерисовка
 
-# 📊 Функция для создания графика расходов по категориям
-def generate_expense_chart():
-	try:
-		import pytz
-		armenia_tz = pytz.timezone('Asia/Yerevan')
-		values = sheet.get("A21:C1000")
-		date_totals = {}
-
-		# 🟢 Получаем значения бюджета из ячеек B17 и B18
-		total_budget = float(sheet.acell("B17").value.strip().replace(",", "").replace(" ", ""))
-		first_day_budget = float(sheet.acell("B18").value.strip().replace(",", ".").replace(" ", ""))
-
-		if first_day_budget > total_budget:
-			print("Warning: First day budget is too high! Using total budget instead.")
-			first_day_budget = total_budget
-
-		print("Total budget (B17):", total_budget)
-		print("First day budget (B18):", first_day_budget)
-
-		for row in values:
-			if len(row) < 3 or not row[1].strip().replace(",", "").replace(" ", "").isdigit():
-				continue
-			date = datetime.strptime(row[2].strip(), "%Y-%m-%d").date()
-			amount = float(row[1].strip().replace(",", "").replace(" ", ""))
-			date_totals[date] = date_totals.get(date, 0) + amount
-
-		# 🟢 Добавляем нулевые траты для всех дней от начала до текущей даты
-		start_date = min(date_totals.keys())
-		end_date = max(date_totals.keys())
-		current_date = start_date
-
-		while current_date <= end_date:
-			if current_date not in date_totals:
-				date_totals[current_date] = 0  # 🟢 Если нет трат за день, ставим 0
-			current_date += timedelta(days=1)
-
-		# 🟢 Добавляем текущую дату с нулевыми тратами, если её ещё нет
-		current_date = datetime.now(armenia_tz).date()
-		if current_date > end_date:
-			date_totals[current_date] = 0
-			end_date = current_date  # 🟢 Обновляем end_date, чтобы синхронизировать длины
-
-		# 🟢 Обновляем списки после добавления нулей
-		sorted_dates = sorted(date_totals.keys())
-		sorted_amounts = [date_totals.get(date, 0) for date in sorted_dates]
-
-		print("Dates and amounts:", date_totals)
-		print("Sorted amounts:", sorted_amounts)
-
-		budget_line = []
-		remaining_budget = total_budget
-		spent_so_far = 0
-
-		for i, date in enumerate(sorted_dates):
-			if i == 0:
-				budget_line.append(first_day_budget)
-			else:
-				spent_so_far += sorted_amounts[i - 1]
-
-			last_day_of_month = date.replace(day=31)
-			remaining_days = (last_day_of_month - date).days
-
-			remaining_budget -= sorted_amounts[i]
-
-			if remaining_days > 0:
-				daily_budget = max(remaining_budget / remaining_days, 0)
-			else:
-				daily_budget = 0
-
-			print(f"Date: {date}, Spent so far: {spent_so_far}, Remaining days: {remaining_days}, Remaining budget: {remaining_budget}, Daily budget: {daily_budget}")
-			
-			# 🟢 Добавляем дневной бюджет только если длины совпадают
-			if len(budget_line) < len(sorted_dates):
-				budget_line.append(daily_budget)
-
-		# 🟢 Строим столбчатую диаграмму для фактических расходов
-		plt.figure(figsize=(10, 5))
-		plt.bar(sorted_dates, sorted_amounts, color='skyblue', label='Фактические расходы')
-
-		# 🟢 Линия для дневного бюджета поверх столбцов
-		plt.plot(sorted_dates, budget_line, linestyle='--', color='orange', label='Дневной бюджет', marker='o')
-
-		plt.title("Расходы по дням")
-		plt.xlabel("Дата")
-		plt.ylabel("Сумма (AMD)")
-		plt.grid(axis='y', linestyle='--', alpha=0.7)
-		plt.xticks(sorted_dates, rotation=45, ha='right')
-		plt.legend()
-		plt.tight_layout()
-
-		image_stream = BytesIO()
-		plt.savefig(image_stream, format='png')
-		image_stream.seek(0)
-		plt.close()
-
-		return image_stream
-	except Exception as e:
-		logging.error(f"Ошибка при генерации графика: {e}")
-		return None
 
+async def get_expense_chart(ledger, chat_id=None, period=None, date_totals=None):
+    # period — (начало, конец) для графика за произвольный диапазон; date_totals тогда уже посчитаны по нему
+    armenia_tz = pytz.timezone('Asia/Yerevan')
+    key = (ledger.key, ledger.generation, ledger.version, datetime.now(armenia_tz).strftime("%Y-%m-%d"), chat_id if CHART_CACHE_PER_CHAT else None, period)
 
+    if key in chart_cache:
+        chart_cache_lookups.inc("hit")
+        chart_cache.move_to_end(key)
+        return chart_cache[key]
+    chart_cache_lookups.inc("miss")
+
+    if key not in chart_renders:
+        today = min(datetime.now(armenia_tz).date(), date_type.fromisoformat(period[1])) if period else None
+        chart_renders[key] = asyncio.ensure_future(generate_expense_chart(ledger, date_totals, today))
+    try:
+        image_bytes = await asyncio.shield(chart_renders[key])
+    finally:
+        if key in chart_renders and chart_renders[key].done():
+            del chart_renders[key]
+
+    if image_bytes:
+        chart_cache[key] = image_bytes
+        chart_cache.move_to_end(key)
+        while len(chart_cache) > CHART_CACHE_SIZE:
+            chart_cache.popitem(last=False)
+    return image_bytes
+
+
+def schedule_chart_prerender(ledger, chat_id):
+    # Серия трат подряд — одна перерисовка: пока запланированная ещё не началась, новую не ставим
+    if chat_id not in chart_prerenders:
+        chart_prerenders[chat_id] = asyncio.create_task(prerender_expense_chart(ledger, chat_id))
+
+
+async def prerender_expense_chart(ledger, chat_id=None):
+    # Фоновая перерисовка после новой траты, чтобы /chart отвечал сразу из кэша.
+    # Траты, пришедшие за CHART_PRERENDER_DELAY, попадут в ту же перерисовку; пришедшие во время отрисовки — в следующую
+    try:
+        await asyncio.sleep(CHART_PRERENDER_DELAY)
+    finally:
+        chart_prerenders.pop(chat_id, None)
+    try:
+        await get_expense_chart(ledger, chat_id)
+    except Exception as e:
+        logging.error(f"Ошибка при фоновой отрисовке графика: {e}")
 
 
 # 🖼 Команда /chart для отправки графика
 @router.message(Command("chart"))
 async def send_expense_chart(message: Message):
     try:
-        image_stream = generate_expense_chart()
-        if image_stream:
-            # 🟢 Сохраняем график во временный файл
-            with open("expense_chart.png", "wb") as f:
-                f.write(image_stream.getbuffer())
-            
-            # 🟢 Отправляем файл как FSInputFile
-            photo = FSInputFile("expense_chart.png")
+        ctx = contexts.get(message.chat.id)
+        ledger = await get_ledger(ctx)
+        args = message.text.split()[1:]
+        if args:
+            # График за период: /chart 2025-01-15 2025-03-10, /chart 2025-02, /chart 30d
+            try:
+                period = parse_period(ctx, args)
+            except ValueError:
+                await message.answer("Формат: /chart [ГГГГ-ММ | ГГГГ-ММ-ДД ГГГГ-ММ-ДД | 30d]")
+                return
+            _, _, date_totals = await range_stats(ctx, *period)
+            if not date_totals:
+                await message.answer("📊 За этот период нет трат.")
+                return
+            image_bytes = await get_expense_chart(ledger, message.chat.id, period, date_totals)
+        else:
+            image_bytes = await get_expense_chart(ledger, message.chat.id)
+        if image_bytes:
+            # 🟢 Отправляем PNG прямо из памяти, без временного файла
+            photo = BufferedInputFile(image_bytes, filename="expense_chart.png")
             await bot.send_photo(chat_id=message.chat.id, photo=photo, caption="📊 График расходов по категориям")
         else:
             await message.answer("Не удалось создать график. Проверь данные в таблице.")
@@ -608,21 +2583,211 @@ async def send_expense_chart(message: Message):
 
 
 
-async def main():
+async def measure_handler(handler, event, data):
+    # Время каждого обработчика сообщений — для гистограммы cashtrack_handler_seconds
+    started = time.perf_counter()
+    handler_object = data.get("handler")
+    name = handler_object.callback.__name__ if handler_object else "unknown"
+    session = profiling.active  # Сообщение, которое само включило профилирование, в окно не считается
+    try:
+        if session is None:
+            return await handler(event, data)
+        with profiling.span(f"handler.{name}"):
+            return await handler(event, data)
+    finally:
+        handler_seconds.observe(name, value=time.perf_counter() - started)
+        if session is not None and session is profiling.active and session.count_request():
+            asyncio.create_task(finish_profiling())
+
+
+async def trace_telegram_request(make_request, bot, method):
+    # Запросы к Bot API (ответы, фото, документы) — отдельными участками профиля
+    if profiling.active is None:
+        return await make_request(bot, method)
+    with profiling.span(f"telegram.{type(method).__name__}"):
+        return await make_request(bot, method)
+
+
+# 🔬 /profile [N] — профилировать следующие N сообщений, /profile stop — закончить раньше (только для ADMIN_CHAT_IDS)
+async def profile_requests(message: Message):
+    if message.chat.id not in ADMIN_CHAT_IDS:
+        await message.answer("Команда доступна только администратору.")
+        return
+    args = message.text.split()[1:]
+    if args and args[0] == "stop":
+        if profiling.active is None:
+            await message.answer("Профилирование не запущено.")
+        else:
+            await finish_profiling()
+        return
+    try:
+        requests_count = int(args[0]) if args else 20
+        if requests_count <= 0:
+            raise ValueError
+    except ValueError:
+        await message.answer("Формат: /profile [число сообщений] или /profile stop")
+        return
+    profiling.start(requests_count, PROFILE_INTERVAL, message.chat.id)
+    await message.answer(f"🔬 Профилирую следующие {requests_count} сообщений. Итоги придут сюда.")
 
+
+async def finish_profiling():
+    session = profiling.stop()
+    if session is None:
+        return
+    prefix = os.path.join(PROFILE_DIR, datetime.now().strftime("profile-%Y%m%d-%H%M%S"))
+    try:
+        paths = await asyncio.to_thread(session.dump, prefix)
+    except OSError as e:
+        logging.error(f"Ошибка при записи профиля: {e}")
+        paths = []
+    summary = session.summary()
+    logging.info(summary)
+    if session.chat_id is None:
+        return
+    try:
+        await bot.send_message(session.chat_id, summary)
+        for path in paths:
+            await bot.send_document(session.chat_id, FSInputFile(path))
+    except Exception as e:
+        logging.error(f"Ошибка при отправке профиля: {e}")
+
+
+async def measure_loop_lag():
+    # Насколько позже положенного просыпается цикл событий — признак блокирующего кода в обработчиках
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag_seconds.observe(value=max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL))
+
+
+async def serve_metrics():
+    # FastAPI и uvicorn нужны только для /metrics — импортируем их, если сервер включён
+    import uvicorn
+    from fastapi import FastAPI
+    from fastapi.responses import PlainTextResponse
+
+    app = FastAPI()
+
+    @app.get("/metrics")
+    async def get_metrics():
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+    server = uvicorn.Server(uvicorn.Config(app, host=METRICS_HOST, port=METRICS_PORT, log_level="warning"))
+    server.capture_signals = contextlib.nullcontext  # Сигналы остановки обрабатывает сам бот
+    await server.serve()
+
+
+async def process_webhook_updates(queue):
+    while True:
+        update = await queue.get()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logging.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+        finally:
+            queue.task_done()
+
+
+async def serve_webhook():
+    import uvicorn
+    from fastapi import FastAPI, Request, Response
+
+    app = FastAPI()
+    # Ограниченная очередь: когда она заполнена, отвечаем 503 и Telegram повторит доставку позже
+    queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    workers = [asyncio.create_task(process_webhook_updates(queue)) for _ in range(WEBHOOK_WORKERS)]
+    metrics.Gauge("cashtrack_webhook_queue_depth", "Обновления из вебхука, ждущие обработки", collect=lambda: {(): queue.qsize()})
+
+    @app.post(WEBHOOK_PATH)
+    async def receive_update(request: Request):
+        if WEBHOOK_SECRET and not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+            return Response(status_code=403)
+        update = types.Update.model_validate(await request.json(), context={"bot": bot})
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logging.warning(f"Очередь вебхука заполнена ({WEBHOOK_QUEUE_SIZE}), обновление {update.update_id} отклонено")
+            return Response(status_code=503)
+        return Response(status_code=200)
+
+    server = uvicorn.Server(uvicorn.Config(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, log_level="warning"))
+    try:
+        await server.serve()
+        # Дорабатываем уже принятые обновления, чтобы Telegram не считал их доставленными впустую
+        await asyncio.wait_for(queue.join(), SHEETS_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning(f"Не успели обработать {queue.qsize()} обновлений из вебхука")
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+
+def register_handlers():
+    dp.message.middleware(measure_handler)
+    bot.session.middleware(trace_telegram_request)
     dp.message.register(get_monthly_stats, Command("stats"))
     dp.message.register(send_expense_chart, Command("chart"))
     dp.message.register(set_fake_date, Command("set_date"))
     dp.message.register(get_budget_left, Command("budget_left"))
     dp.message.register(reset_budget, Command("budget_default"))  # Сброс бюджета
     dp.message.register(get_current_budget, Command("budget_now"))  # Просмотр текущего бюджета
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    dp.message.register(resync_ledger, Command("resync"))  # Перечитать таблицу после ручных правок
+    dp.message.register(get_sheets_status, Command("sheets_status"))  # Очередь и квоты Google Sheets
+    dp.message.register(export_expenses, Command("export"))  # Выгрузка трат в CSV
+    dp.message.register(get_history, Command("history"))  # Траты по месяцам из листов ГГГГ-ММ
+    dp.message.register(get_forecast, Command("forecast"))  # Прогноз остатка на конец месяца
+    dp.message.register(subscribe_reports, Command("subscribe"))  # Регулярные отчёты в этот чат
+    dp.message.register(unsubscribe_reports, Command("unsubscribe"))
+    dp.message.register(profile_requests, Command("profile"))  # Профилирование следующих сообщений (админ)
+    dp.message.register(import_expenses_file, F.document)  # Загрузка трат из CSV-файла
 
 
-   # 🟢 Добавляем планировщик задач в main
+async def main():
+    startup_timings["imports"] = time.perf_counter() - _import_started
+
+    register_handlers()
+    if PROFILE_REQUESTS:
+        profiling.start(PROFILE_REQUESTS, PROFILE_INTERVAL)
+    if METRICS_PORT:
+        asyncio.create_task(serve_metrics())
+        asyncio.create_task(measure_loop_lag())
+    asyncio.create_task(ledger_resync_loop())
+    asyncio.create_task(evict_idle_contexts_loop())
+    asyncio.create_task(snapshot_loop())
+    asyncio.create_task(asyncio.to_thread(start_chart_pool))
+    # 🟢 Планировщик запускается до опроса — после start_polling управление сюда не возвращается
     scheduler.start()
 
+    # Сначала подключаемся к Telegram, таблица загружается в фоне
+    started = time.perf_counter()
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=True,
+        )
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+    startup_timings["telegram"] = time.perf_counter() - started
+    asyncio.create_task(connect_sheets())
+    try:
+        if WEBHOOK_URL:
+            await serve_webhook()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        scheduler.shutdown(wait=False)
+        # Не теряем траты, которые ещё не успели записаться
+        for ledger in list(ledgers.values()):
+            await ledger.stop_writer()
+            await save_snapshot(ledger)
+        sheets_executor.shutdown(wait=False)
+        chart_executor.shutdown(wait=False, cancel_futures=True)
+        if WEBHOOK_URL:
+            await bot.session.close()  # При опросе сессию закрывает start_polling
 
 
 if __name__ == "__main__":
@@ -0,0 +1,63 @@
+import numpy as np
+
+
+# 💰 Расчёт дневного бюджета на NumPy: вся кривая месяца (или сразу много чатов/сценариев) за один проход.
+# Суммы передаются массивами формы (..., дни): первая ось — чаты или сценарии, последняя — подряд идущие дни.
+
+
+def days_in_month(dates):
+    # Настоящая длина месяца для каждой даты (datetime64[D])
+    months = dates.astype("datetime64[M]")
+    return ((months + 1).astype("datetime64[D]") - months.astype("datetime64[D]")).astype(int)
+
+
+def days_left(dates):
+    # Сколько дней осталось до конца месяца, включая сам день
+    month_end = (dates.astype("datetime64[M]") + 1).astype("datetime64[D]") - 1
+    return (month_end - dates).astype(int) + 1
+
+
+def budget_curve(dates, amounts, monthly_budget):
+    # Для каждого дня: допустимый лимит на этот день (с учётом трат до него) и остаток бюджета после него.
+    # Траты копятся внутри месяца и сбрасываются с началом следующего.
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    amounts = np.asarray(amounts, dtype=float)
+    budget = np.asarray(monthly_budget, dtype=float)[..., None]
+
+    months = dates.astype("datetime64[M]")
+    month_starts = np.r_[True, months[1:] != months[:-1]]
+    start_index = np.maximum.accumulate(np.where(month_starts, np.arange(len(dates)), 0))
+
+    spent_through = np.cumsum(amounts, axis=-1)
+    spent_before_month = (spent_through - amounts)[..., start_index]
+    spent_through = spent_through - spent_before_month
+    spent_before = spent_through - amounts
+
+    limits = np.maximum((budget - spent_before) / days_left(dates), 0)
+    remaining = budget - spent_through
+    return limits, remaining
+
+
+def forecast_month(amounts, monthly_budget, month_length, daily_spend=None, window=7):
+    # Прогноз остатка на конец месяца по темпу трат.
+    # amounts — траты за прошедшие дни месяца (включая сегодня), daily_spend — свой темп («что если»), иначе средний.
+    amounts = np.atleast_2d(np.asarray(amounts, dtype=float))
+    budget = np.asarray(monthly_budget, dtype=float)
+    elapsed = amounts.shape[-1]
+    spent = amounts.sum(axis=-1)
+
+    if daily_spend is None:
+        daily_spend = spent / max(elapsed, 1)
+    daily_spend = np.asarray(daily_spend, dtype=float)
+    recent_spend = amounts[..., -window:].mean(axis=-1) if elapsed else np.zeros_like(spent)
+
+    remaining_days = max(month_length - elapsed, 0)
+    return {
+        "spent": spent,
+        "daily_spend": daily_spend * np.ones_like(spent),
+        "recent_spend": recent_spend,
+        "projected_total": spent + daily_spend * remaining_days,
+        "projected_balance": budget - spent - daily_spend * remaining_days,
+        # Сколько можно тратить в день до конца месяца, чтобы уложиться в бюджет
+        "allowed_daily": np.maximum(budget - spent, 0) / max(remaining_days, 1),
+    }
@@ -0,0 +1,73 @@
+import logging
+from datetime import timedelta
+from io import BytesIO
+
+
+# numpy и matplotlib импортируются только в процессах пула (warm_up при их старте), поэтому
+# import charts в основном процессе ничего не стоит и не блокирует цикл событий
+def warm_up():
+    import matplotlib
+    matplotlib.use("Agg")  # Рисуем без дисплея
+    import matplotlib.pyplot
+    import budget
+
+
+# 📊 График расходов по дням с линией дневного бюджета.
+# Выполняется в пуле процессов, поэтому получает только готовые данные и возвращает PNG-байты.
+def render_expense_chart(date_totals, total_budget, first_day_budget, today):
+    warm_up()
+    import numpy as np
+    import matplotlib.pyplot as plt
+    import budget
+
+    date_totals = dict(date_totals)
+
+    if first_day_budget > total_budget:
+        logging.warning(f"Бюджет первого дня ({first_day_budget}) больше месячного ({total_budget}) — берём месячный")
+        first_day_budget = total_budget
+
+    # 🟢 Добавляем нулевые траты для всех дней от начала до текущей даты
+    start_date = min(date_totals.keys())
+    end_date = max(date_totals.keys())
+    current_date = start_date
+
+    while current_date <= end_date:
+        if current_date not in date_totals:
+            date_totals[current_date] = 0  # 🟢 Если нет трат за день, ставим 0
+        current_date += timedelta(days=1)
+
+    # 🟢 Добавляем текущую дату с нулевыми тратами, если её ещё нет
+    if today > end_date:
+        date_totals[today] = 0
+        end_date = today  # 🟢 Обновляем end_date, чтобы синхронизировать длины
+
+    # 🟢 Обновляем списки после добавления нулей
+    sorted_dates = sorted(date_totals.keys())
+    sorted_amounts = [date_totals.get(date, 0) for date in sorted_dates]
+
+    logging.debug(f"График: {len(sorted_dates)} дней с {sorted_dates[0]} по {sorted_dates[-1]}, бюджет {total_budget}, первый день {first_day_budget}")
+
+    # 🟢 Линия дневного бюджета — одним векторным расчётом с настоящей длиной месяца
+    limits, _ = budget.budget_curve(np.array(sorted_dates, dtype="datetime64[D]"), sorted_amounts, total_budget)
+    budget_line = [first_day_budget] + limits[1:].tolist()
+
+    # 🟢 Строим столбчатую диаграмму для фактических расходов
+    plt.figure(figsize=(10, 5))
+    plt.bar(sorted_dates, sorted_amounts, color='skyblue', label='Фактические расходы')
+
+    # 🟢 Линия для дневного бюджета поверх столбцов
+    plt.plot(sorted_dates, budget_line, linestyle='--', color='orange', label='Дневной бюджет', marker='o')
+
+    plt.title("Расходы по дням")
+    plt.xlabel("Дата")
+    plt.ylabel("Сумма (AMD)")
+    plt.grid(axis='y', linestyle='--', alpha=0.7)
+    plt.xticks(sorted_dates, rotation=45, ha='right')
+    plt.legend()
+    plt.tight_layout()
+
+    image_stream = BytesIO()
+    plt.savefig(image_stream, format='png')
+    plt.close()
+
+    return image_stream.getvalue()
@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import inspect
+import functools
+import threading
+import contextlib
+import contextvars
+from collections import Counter
+
+# Профилирование по запросу: таймеры участков кода (span) и сэмплирование стека цикла событий.
+# Пока сеанс не запущен, span() отдаёт общий пустой контекст — вся цена выключенного профилирования в одной проверке
+
+NULL_SPAN = contextlib.nullcontext()
+
+active = None  # Текущий сеанс или None
+current_path = contextvars.ContextVar("profiling_path", default=())  # Вложенные участки текущей задачи asyncio
+
+
+def span(name):
+    session = active
+    if session is None:
+        return NULL_SPAN
+    return Span(session, name)
+
+
+def traced(name):
+    # Декоратор: каждый вызов функции — участок name
+    def decorate(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if active is None:
+                    return await func(*args, **kwargs)
+                with Span(active, name):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if active is None:
+                    return func(*args, **kwargs)
+                with Span(active, name):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class Span:
+    __slots__ = ("session", "path", "token", "started")
+
+    def __init__(self, session, name):
+        self.session = session
+        self.path = current_path.get() + (name,)
+
+    def __enter__(self):
+        self.token = current_path.set(self.path)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        current_path.reset(self.token)
+        self.session.record(self.path, elapsed)
+        return False
+
+
+class Session:
+    def __init__(self, requests, interval, chat_id=None):
+        self.remaining = requests  # Сколько ещё сообщений профилировать
+        self.requests = 0
+        self.chat_id = chat_id  # Куда отправить итоги; None — только в лог
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.finished = None
+        self.spans = {}  # Путь участков -> [вызовов, сумма секунд, максимум]
+        self.samples = Counter()  # Свёрнутый стек -> число сэмплов
+        self.lock = threading.Lock()  # Участки закрываются и в потоках пула Sheets
+        self.target = threading.get_ident()  # Поток цикла событий — его и сэмплируем
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample_loop, name="profiler", daemon=True)
+
+    def record(self, path, elapsed):
+        with self.lock:
+            stats = self.spans.get(path)
+            if stats is None:
+                self.spans[path] = [1, elapsed, elapsed]
+            else:
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+
+    def count_request(self):
+        # True, когда окно профилирования исчерпано
+        self.requests += 1
+        self.remaining -= 1
+        return self.remaining <= 0
+
+    def sample_loop(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def folded_spans(self):
+        # Формат flamegraph.pl / speedscope: у каждой строки собственное время участка без вложенных, в микросекундах
+        spans = self.span_stats()
+        children = Counter()
+        for path, (_, total, _) in spans.items():
+            if len(path) > 1:
+                children[path[:-1]] += total
+        return [
+            f"{';'.join(path)} {max(round((total - children[path]) * 1e6), 0)}"
+            for path, (_, total, _) in sorted(spans.items())
+        ]
+
+    def span_stats(self):
+        # Копия: задачи, начатые до остановки, ещё могут закрывать свои участки
+        with self.lock:
+            return {path: list(stats) for path, stats in self.spans.items()}
+
+    def folded_samples(self):
+        return [f"{stack} {count}" for stack, count in self.samples.most_common()]
+
+    def dump(self, prefix):
+        # prefix.spans.folded — время по участкам, prefix.samples.folded — сэмплы стека; оба открываются в flamegraph.pl
+        os.makedirs(os.path.dirname(prefix) or ".", exist_ok=True)
+        paths = []
+        for suffix, lines in (("spans", self.folded_spans()), ("samples", self.folded_samples())):
+            path = f"{prefix}.{suffix}.folded"
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            paths.append(path)
+        return paths
+
+    def summary(self, limit=15):
+        duration = (self.finished or time.perf_counter()) - self.started
+        by_name = {}
+        for path, (calls, total, longest) in self.span_stats().items():
+            stats = by_name.setdefault(path[-1], [0, 0.0, 0.0])
+            stats[0] += calls
+            stats[1] += total
+            stats[2] = max(stats[2], longest)
+        lines = [f"🔬 Профиль: {self.requests} сообщений за {duration:.1f} с, сэмплов стека: {sum(self.samples.values())}"]
+        if by_name:
+            lines.append("Участки (всего мс / вызовов / среднее мс / макс мс):")
+            for name, (calls, total, longest) in sorted(by_name.items(), key=lambda item: item[1][1], reverse=True)[:limit]:
+                lines.append(f"{name}: {total * 1000:.1f} / {calls} / {total * 1000 / calls:.2f} / {longest * 1000:.1f}")
+        leaves = Counter()
+        for stack, count in self.samples.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        if leaves:
+            sampled = sum(leaves.values())
+            lines.append("Где стоял цикл событий (доля сэмплов):")
+            for leaf, count in leaves.most_common(5):
+                lines.append(f"{leaf}: {count * 100 / sampled:.0f}%")
+        return "\n".join(lines)
+
+
+def start(requests, interval, chat_id=None):
+    # Вызывается из цикла событий: сэмплируется именно его поток
+    global active
+    if active is not None:
+        stop()
+    session = Session(requests, interval, chat_id)
+    session.sampler.start()
+    active = session
+    return session
+
+
+def stop():
+    global active
+    session, active = active, None
+    if session is not None:
+        session.finished = time.perf_counter()
+        session.stopped.set()
+        session.sampler.join()
+    return session
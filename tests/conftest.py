@@ -0,0 +1,10 @@
+import os
+import sys
+
+# bot.py читает настройки при импорте — задаём их до того, как тесты его импортируют
+os.environ.setdefault("BOT_TOKEN", "123456:TESTTESTTESTTESTTESTTESTTESTTESTTEST")
+os.environ.setdefault("SPREADSHEET_NAME", "test")
+os.environ.setdefault("CREDENTIALS_FILE", "{}")
+os.environ.setdefault("SNAPSHOT_DIR", "")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+import budget
+
+DATES = np.array(["2025-01-30", "2025-01-31", "2025-02-01", "2025-02-02"], dtype="datetime64[D]")
+
+
+def test_month_lengths():
+    assert budget.days_in_month(np.array(["2024-02-10", "2025-02-10", "2025-04-30"], dtype="datetime64[D]")).tolist() == [29, 28, 30]
+    assert budget.days_left(DATES).tolist() == [2, 1, 28, 27]
+
+
+def test_budget_curve_resets_each_month():
+    limits, remaining = budget.budget_curve(DATES, [100, 50, 280, 0], 1000)
+    # Лимит дня — остаток до этого дня, делённый на оставшиеся дни месяца (включая сам день)
+    assert limits.tolist() == pytest.approx([1000 / 2, 900 / 1, 1000 / 28, 720 / 27])
+    assert remaining.tolist() == pytest.approx([900, 850, 720, 720])
+
+
+def test_budget_curve_never_goes_negative():
+    limits, remaining = budget.budget_curve(DATES[:2], [1500, 0], 1000)
+    assert limits.tolist() == pytest.approx([500, 0])
+    assert remaining.tolist() == pytest.approx([-500, -500])
+
+
+def test_budget_curve_for_many_chats_at_once():
+    amounts = np.array([[100, 50, 280, 0], [0, 0, 0, 0]])
+    limits, _ = budget.budget_curve(DATES, amounts, [1000, 2800])
+    assert limits.shape == (2, 4)
+    assert limits[0].tolist() == pytest.approx(budget.budget_curve(DATES, amounts[0], 1000)[0].tolist())
+    assert limits[1].tolist() == pytest.approx([1400, 2800, 2800 / 28, 2800 / 27])
@@ -0,0 +1,81 @@
+from datetime import date
+
+import pytest
+
+import bot
+from bench.fake_sheets import make_spreadsheet_values
+
+
+def day(text):
+    return date.fromisoformat(text).toordinal()
+
+
+@pytest.fixture
+def index():
+    return bot.PrefixSums.from_totals({day("2025-01-05"): 100, day("2025-01-01"): 10, day("2025-01-03"): 1})
+
+
+def test_prefix_sums_range_queries(index):
+    assert index.sum(day("2025-01-01"), day("2025-01-05")) == 111
+    assert index.sum(day("2025-01-02"), day("2025-01-04")) == 1  # Границы без трат
+    assert index.sum(day("2025-01-03"), day("2025-01-03")) == 1  # Один день
+    assert index.sum(day("2024-12-01"), day("2024-12-31")) == 0  # До первой траты
+    assert index.sum(day("2025-01-06"), day("2025-02-01")) == 0  # После последней
+    assert index.daily(day("2025-01-02"), day("2025-01-31")) == [(day("2025-01-03"), 1), (day("2025-01-05"), 100)]
+
+
+def test_prefix_sums_add(index):
+    index.add(day("2025-01-05"), 5)  # Существующий день
+    index.add(day("2025-01-02"), 1000)  # Задним числом между днями
+    index.add(day("2024-12-31"), 7)  # Раньше всех
+    index.add(day("2025-01-09"), 3)  # Новый последний день
+    assert index.sum(day("2025-01-01"), day("2025-01-05")) == 1116
+    assert index.sum(day("2024-12-31"), day("2025-01-31")) == 1126
+    assert index.daily(day("2024-12-31"), day("2025-01-02")) == [(day("2024-12-31"), 7), (day("2025-01-01"), 10), (day("2025-01-02"), 1000)]
+    assert index.totals == sorted(index.totals)
+
+
+def make_ledger(rows=50):
+    ledger = bot.Ledger(("test", None))
+    ledger.set_values(make_spreadsheet_values(rows, today=date(2025, 3, 15)))
+    return ledger
+
+
+def test_snapshot_round_trip():
+    ledger = make_ledger()
+    ledger.add_to_mirror("новая", 12.5, "2025-03-15")
+    data = ledger.dump_snapshot({42: (1500.0, "2025-03-15")})
+
+    restored = bot.Ledger(("test", None))
+    restored.restore_snapshot(data)
+    for column in ("amounts", "days", "category_ids"):
+        assert getattr(restored.expenses, column) == getattr(ledger.expenses, column)
+    assert restored.expenses.categories == ledger.expenses.categories
+    assert restored.expenses.sheet_rows == ledger.expenses.sheet_rows
+    assert restored.header == ledger.header
+    assert restored.day_totals == ledger.day_totals
+    assert restored.month_category_totals == ledger.month_category_totals
+    assert restored.saved_budgets == {42: (1500.0, "2025-03-15")}
+    assert restored.from_snapshot
+    first, last = day("2025-01-01"), day("2025-03-31")
+    assert restored.day_index.sum(first, last) == ledger.day_index.sum(first, last)
+    assert restored.category_index["новая"].sum(first, last) == 12.5
+
+
+def test_snapshot_rejects_other_sheet():
+    data = make_ledger().dump_snapshot({})
+    with pytest.raises(ValueError):
+        bot.Ledger(("test", "2025-01")).restore_snapshot(data)
+
+
+@pytest.mark.parametrize("damage", [
+    lambda data: data[:len(data) // 2],  # Обрезан
+    lambda data: b"XXXXXX" + data[6:],  # Чужой файл
+    lambda data: data[:6] + (bot.SNAPSHOT_VERSION + 1).to_bytes(2, "little") + data[8:],  # Другая версия формата
+])
+def test_snapshot_rejects_damaged_file(damage):
+    data = damage(make_ledger().dump_snapshot({}))
+    ledger = bot.Ledger(("test", None))
+    with pytest.raises(ValueError):
+        ledger.restore_snapshot(data)
+    assert not ledger.ready.is_set()
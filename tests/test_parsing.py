@@ -0,0 +1,47 @@
+import csv
+
+import bot
+
+TODAY = "2025-03-15"
+
+
+def parse(text, skip_header=False):
+    return bot.parse_expense_rows(csv.reader(text.splitlines()), TODAY, skip_header)
+
+
+def test_rows_with_and_without_date():
+    rows, errors = parse("еда, 1500\nтакси, 250.5, 2025-03-01\n\n")
+    assert rows == [["еда", 1500.0, TODAY], ["такси", 250.5, "2025-03-01"]]
+    assert errors == []
+
+
+def test_csv_header_is_skipped_only_when_asked():
+    assert parse("category,amount,date\nеда,10,2025-03-01", skip_header=True) == ([["еда", 10.0, "2025-03-01"]], [])
+    _, errors = parse("category,amount,date\nеда,10,2025-03-01")
+    assert errors == ["Строка 1: сумма должна быть числом"]
+
+
+def test_every_bad_line_is_reported():
+    rows, errors = parse("еда, 1.2.3\nкофе, -5\nкафе, 100, 15.03.2025\nтолько категория\n, 100\nдом, 300")
+    assert rows == [["дом", 300.0, TODAY]]
+    assert errors == [
+        "Строка 1: сумма должна быть числом",
+        "Строка 2: сумма должна быть числом",
+        "Строка 3: дата должна быть в формате ГГГГ-ММ-ДД",
+        "Строка 4: нужен формат «категория, сумма» или «категория, сумма, ГГГГ-ММ-ДД»",
+        "Строка 5: нужен формат «категория, сумма» или «категория, сумма, ГГГГ-ММ-ДД»",
+    ]
+
+
+def test_row_limit(monkeypatch):
+    monkeypatch.setattr(bot, "IMPORT_MAX_ROWS", 2)
+    rows, errors = parse("а, 1\nб, 2\nв, 3\nг, 4")
+    assert len(rows) == 2
+    assert errors == ["За раз можно записать не больше 2 трат"]
+
+
+def test_sheet_rows():
+    assert bot.parse_expense_row(["еда", "1\xa0500", " 2025-03-01 "]) == ("еда", 1500.0, "2025-03-01")
+    assert bot.parse_expense_row(["еда", "1,500.5", "2025-03-01"]) == ("еда", 1500.5, "2025-03-01")
+    assert bot.parse_expense_row(["Итого", "—", ""]) is None
+    assert bot.parse_expense_row(["еда", "100"]) is None
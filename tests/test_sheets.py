@@ -0,0 +1,160 @@
+import asyncio
+from types import SimpleNamespace
+
+import gspread
+import pytest
+import requests
+import urllib3
+
+import bot
+from bench.fake_sheets import FakeClient
+
+
+def api_error(code):
+    response = SimpleNamespace(status_code=code, json=lambda: {"error": {"code": code, "message": "test", "status": "test"}}, text="test")
+    return gspread.exceptions.APIError(response)
+
+
+def connection_refused():
+    reason = urllib3.exceptions.NewConnectionError(None, "connection refused")
+    return requests.exceptions.ConnectionError(urllib3.exceptions.MaxRetryError(None, "/", reason))
+
+
+def failing(method, errors):
+    # Метод подставного листа, который сначала бросает errors по одной, а потом работает как обычно
+    calls = []
+
+    def call(*args, **kwargs):
+        calls.append(args)
+        if errors:
+            raise errors.pop(0)
+        return method(*args, **kwargs)
+
+    call.__name__ = method.__name__  # По имени метода планировщик выбирает квоту и правила повтора
+    call.calls = calls
+    return call
+
+
+@pytest.fixture
+def worksheet():
+    return FakeClient(rows=5).open_by_key("test").sheet1
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(bot, "SHEETS_BACKOFF_BASE", 0)
+    monkeypatch.setattr(bot, "SHEETS_MAX_RETRIES", 3)
+
+
+def run(func, *args):
+    async def main():
+        scheduler = bot.SheetsScheduler(60000, 60000)
+        return await scheduler.call(func, *args)
+    return asyncio.run(main())
+
+
+ROW = [["еда", 100, "2025-01-01"]]
+
+
+@pytest.mark.parametrize("error", [api_error(500), api_error(503), requests.exceptions.ReadTimeout()])
+def test_append_is_not_retried_when_it_may_have_reached_the_sheet(worksheet, error):
+    rows = len(worksheet.values)
+    append_rows = failing(worksheet.append_rows, [error])
+    with pytest.raises(type(error)):
+        run(append_rows, ROW)
+    assert len(append_rows.calls) == 1
+    assert len(worksheet.values) == rows
+
+
+@pytest.mark.parametrize("error", [api_error(429), requests.exceptions.ConnectTimeout(), connection_refused()])
+def test_append_is_retried_when_the_request_was_not_accepted(worksheet, error):
+    rows = len(worksheet.values)
+    append_rows = failing(worksheet.append_rows, [error])
+    run(append_rows, ROW)
+    assert len(append_rows.calls) == 2
+    assert len(worksheet.values) == rows + 1
+
+
+@pytest.mark.parametrize("error", [api_error(500), api_error(429), requests.exceptions.ReadTimeout(), connection_refused()])
+def test_reads_and_idempotent_writes_are_retried(worksheet, error):
+    get = failing(worksheet.get, [error])
+    assert run(get, "A1:C1") == [["Статья расходов", "Стоимость, AMD"]]
+    assert len(get.calls) == 2
+
+    update = failing(worksheet.update, [error])
+    run(update, "D1", [["x"]])
+    assert len(update.calls) == 2
+
+
+def test_retries_stop_after_the_limit(worksheet):
+    get = failing(worksheet.get, [api_error(500) for _ in range(10)])
+    with pytest.raises(gspread.exceptions.APIError):
+        run(get, "A1:C1")
+    assert len(get.calls) == bot.SHEETS_MAX_RETRIES + 1
+
+
+def test_client_errors_are_not_retried(worksheet):
+    get = failing(worksheet.get, [api_error(400)])
+    with pytest.raises(gspread.exceptions.APIError):
+        run(get, "A1:C1")
+    assert len(get.calls) == 1
+
+
+def test_request_not_sent():
+    assert bot.request_not_sent(requests.exceptions.ConnectTimeout())
+    assert bot.request_not_sent(connection_refused())
+    assert not bot.request_not_sent(requests.exceptions.ReadTimeout())
+    assert not bot.request_not_sent(requests.exceptions.ConnectionError("connection reset"))
+    assert not bot.request_not_sent(api_error(500))
+
+
+def test_single_flight_shares_reads_until_a_write():
+    async def main():
+        reads = bot.SingleFlight(freshness=60)
+        fetched = []
+
+        async def fetch():
+            fetched.append(None)
+            number = len(fetched)
+            await asyncio.sleep(0.01)
+            return number
+
+        first = asyncio.ensure_future(reads.call("key", "sheet", "get", fetch))
+        await asyncio.sleep(0)
+        shared = await reads.call("key", "sheet", "get", fetch)
+        assert (await first, shared) == (1, 1)
+        assert await reads.call("key", "sheet", "get", fetch) == 1  # Ещё свежий результат
+
+        # Запись в ту же таблицу: готовый результат больше не отдаётся...
+        reads.invalidate("sheet")
+        in_flight = asyncio.ensure_future(reads.call("key", "sheet", "get", fetch))
+        await asyncio.sleep(0)
+        # ...как и чтение, начатое до следующей записи
+        reads.invalidate("sheet")
+        assert await reads.call("key", "sheet", "get", fetch) == 3
+        assert await in_flight == 2
+
+        # Запись в другую таблицу на эту не влияет
+        reads.invalidate("other")
+        assert await reads.call("key", "sheet", "get", fetch) == 3
+        assert reads.shared == 3
+
+    asyncio.run(main())
+
+
+def test_single_flight_does_not_share_failures():
+    async def main():
+        reads = bot.SingleFlight(freshness=60)
+        results = [ValueError("boom"), "ok"]
+
+        async def fetch():
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        with pytest.raises(ValueError):
+            await reads.call("key", "sheet", "get", fetch)
+        assert await reads.call("key", "sheet", "get", fetch) == "ok"
+
+    asyncio.run(main())